@@ -2,16 +2,68 @@
 
 El-Kishky, Ahmed, et al. "Scalable topical phrase mining from text corpora." Proceedings of the VLDB Endowment 8.3 (2014): 305-316.
 """
-import subprocess, shlex
-def get_output_of(command):
-	args = shlex.split(command)
-	return subprocess.Popen(args, stdout=subprocess.PIPE).communicate()[0]
+import argparse
+from topmine_src.pipeline import TopMine
+from topmine_src.instrumentation import Instrumentation
 
-file_name="input/dblp_5k.txt"
-num_topics=4
+parser = argparse.ArgumentParser(description="Mines the phrases of a corpus and their topics.")
+parser.add_argument("file_name", nargs="?", default="input/dblp_5k.txt", help="input corpus, one document per line")
+parser.add_argument("--num-topics", type=int, default=4)
+parser.add_argument("--min-support", type=int, default=10, help="minimum number of occurrences of a phrase")
+parser.add_argument("--max-phrase-size", type=int, default=10)
+parser.add_argument("--significance-threshold", type=float, default=4,
+                    help="threshold for merging two words into a phrase; lower values favor recall")
+parser.add_argument("--sentence-delimiters", default=".,;!?",
+                    help="characters ending a sentence; phrases never span two sentences")
+parser.add_argument("--alpha", type=float, default=4)
+parser.add_argument("--beta", type=float, default=0.01)
+parser.add_argument("--iterations", type=int, default=1100)
+parser.add_argument("--optimization-iterations", type=int, default=50)
+parser.add_argument("--optimization-burnin", type=int, default=100)
+parser.add_argument("--sampler", choices=["python", "numpy", "sparse"], default="python")
+parser.add_argument("--mining-workers", type=int, default=1, help="number of processes of the phrase mining")
+parser.add_argument("--lda-workers", type=int, default=1,
+                    help="number of processes of PhraseLDA; more than one samples with approximate AD-LDA")
+parser.add_argument("--likelihood-iterations", type=int, default=None)
+parser.add_argument("--convergence-tolerance", type=float, default=None)
+parser.add_argument("--top-phrases", type=int, default=None,
+                    help="number of frequent phrases, and of phrases per topic, to store; all by default")
+parser.add_argument("--output-dir", default="output")
+parser.add_argument("--intermediate-dir", default="intermediate_output")
+parser.add_argument("--store-intermediate", action="store_true",
+                    help="also write the partitioned docs, vocabulary, phrase topics and model")
+parser.add_argument("--intermediate-format", choices=["binary", "text"], default="binary")
+parser.add_argument("--metrics-file", default=None, help="JSON file receiving the time of every stage")
+parser.add_argument("--cache-dir", default=None,
+                    help="directory where the mining results are cached and reused for the same input and parameters")
+parser.add_argument("--cache-max-mb", type=int, default=1024, help="maximum size of the mining cache")
+arguments = parser.parse_args()
 
-phrase_mining_cmd = "pypy topmine_src/run_phrase_mining.py {0}".format(file_name)
-print get_output_of(phrase_mining_cmd)
-
-phrase_lda_cmd = "pypy topmine_src/run_phrase_lda.py {0}".format(num_topics)
-print get_output_of(phrase_lda_cmd)
\ No newline at end of file
+instrumentation = Instrumentation() if arguments.metrics_file is not None else None
+topmine = TopMine(arguments.file_name,
+                  num_topics=arguments.num_topics,
+                  min_support=arguments.min_support,
+                  max_phrase_size=arguments.max_phrase_size,
+                  significance_threshold=arguments.significance_threshold,
+                  sentence_delimiters=arguments.sentence_delimiters,
+                  alpha=arguments.alpha,
+                  beta=arguments.beta,
+                  iterations=arguments.iterations,
+                  optimization_iterations=arguments.optimization_iterations,
+                  optimization_burnin=arguments.optimization_burnin,
+                  sampler=arguments.sampler,
+                  mining_workers=arguments.mining_workers,
+                  lda_workers=arguments.lda_workers,
+                  likelihood_iterations=arguments.likelihood_iterations,
+                  convergence_tolerance=arguments.convergence_tolerance,
+                  output_dir=arguments.output_dir,
+                  intermediate_dir=arguments.intermediate_dir,
+                  store_intermediate=arguments.store_intermediate,
+                  intermediate_format=arguments.intermediate_format,
+                  instrumentation=instrumentation,
+                  cache_dir=arguments.cache_dir,
+                  cache_max_bytes=arguments.cache_max_mb << 20,
+                  top_phrases=arguments.top_phrases)
+topmine.run()
+if instrumentation is not None:
+    instrumentation.write(arguments.metrics_file)
@@ -0,0 +1,161 @@
+from array import array
+from bisect import bisect_right
+
+
+class PartitionedCorpus(object):
+    """
+    Partitioned documents stored as three flat arrays, in the spirit of a CSR
+    matrix, instead of nested lists of lists of word ids.
+    :param tokens:
+        Word ids of every phrase of every document, back to back.
+    :param phrase_offsets:
+        Phrase ``p`` is ``tokens[phrase_offsets[p]:phrase_offsets[p+1]]``.
+    :param document_offsets:
+        Document ``d`` is made of the phrases ``document_offsets[d]`` up to
+        ``document_offsets[d+1] - 1``.
+    """
+
+    def __init__(self, tokens, phrase_offsets, document_offsets):
+        self.tokens = tokens
+        self.phrase_offsets = phrase_offsets
+        self.document_offsets = document_offsets
+        self.num_documents = len(document_offsets) - 1
+        self.num_phrases = len(phrase_offsets) - 1
+
+    @classmethod
+    def from_partitioned_docs(cls, partitioned_docs):
+        """
+        Builds the corpus from a list of documents, each a list of phrases of word ids.
+        """
+        tokens = array('i')
+        phrase_offsets = array('l', [0])
+        document_offsets = array('l', [0])
+        for document in partitioned_docs:
+            for phrase in document:
+                tokens.extend(phrase)
+                phrase_offsets.append(len(tokens))
+            document_offsets.append(len(phrase_offsets) - 1)
+        return cls(tokens, phrase_offsets, document_offsets)
+
+    def to_arrays(self):
+        """
+        Returns the corpus with its values in arrays, itself if they already are.
+        Plain Python code reads arrays much faster than NumPy arrays, whose every
+        element is boxed into a NumPy scalar.
+        """
+        if isinstance(self.tokens, array) and isinstance(self.phrase_offsets, array) \
+                and isinstance(self.document_offsets, array):
+            return self
+        tokens = array('i')
+        tokens.fromstring(self.tokens.tostring())
+        phrase_offsets = array('l')
+        phrase_offsets.fromstring(self.phrase_offsets.tostring())
+        document_offsets = array('l')
+        document_offsets.fromstring(self.document_offsets.tostring())
+        return PartitionedCorpus(tokens, phrase_offsets, document_offsets)
+
+    def __len__(self):
+        return self.num_documents
+
+    def __getitem__(self, document_index):
+        """
+        Returns the document as a list of phrases of word ids.
+        """
+        return [self.phrase(phrase_index) for phrase_index in self.phrases_of(document_index)]
+
+    def __iter__(self):
+        for document_index in range(self.num_documents):
+            yield self[document_index]
+
+    def phrases_of(self, document_index):
+        """
+        Returns the range of phrase indices of the document.
+        """
+        return range(self.document_offsets[document_index], self.document_offsets[document_index + 1])
+
+    def phrase(self, phrase_index):
+        return self.tokens[self.phrase_offsets[phrase_index]:self.phrase_offsets[phrase_index + 1]]
+
+    def phrase_length(self, phrase_index):
+        return self.phrase_offsets[phrase_index + 1] - self.phrase_offsets[phrase_index]
+
+    def document_length(self, document_index):
+        """
+        Returns the number of words in the document.
+        """
+        return (self.phrase_offsets[self.document_offsets[document_index + 1]]
+                - self.phrase_offsets[self.document_offsets[document_index]])
+
+    def split_by_document(self, values):
+        """
+        Splits a sequence holding one value per phrase into one slice per document.
+        """
+        return [values[self.document_offsets[document_index]:self.document_offsets[document_index + 1]]
+                for document_index in range(self.num_documents)]
+
+
+class SentenceCorpus(object):
+    """
+    Sentences of word ids stored back to back in one flat array, like the phrases
+    of PartitionedCorpus, instead of one array per sentence.
+    :param tokens:
+        Word ids of every sentence, back to back.
+    :param sentence_offsets:
+        Sentence ``s`` is ``tokens[sentence_offsets[s]:sentence_offsets[s+1]]``.
+    """
+
+    def __init__(self, tokens=None, sentence_offsets=None):
+        self.tokens = array('i') if tokens is None else tokens
+        self.sentence_offsets = array('l', [0]) if sentence_offsets is None else sentence_offsets
+
+    @classmethod
+    def from_sentences(cls, sentences):
+        """
+        Builds the corpus from a list of sentences, each a sequence of word ids.
+        """
+        corpus = cls()
+        for sentence in sentences:
+            corpus.tokens.extend(sentence)
+            corpus.end_sentence()
+        return corpus
+
+    def end_sentence(self):
+        """
+        Ends the current sentence after the last token added.
+        """
+        self.sentence_offsets.append(len(self.tokens))
+
+    def extend(self, other):
+        """
+        Appends the sentences of another SentenceCorpus.
+        """
+        offset = len(self.tokens)
+        self.tokens.extend(other.tokens)
+        self.sentence_offsets.extend(offset + end for end in other.sentence_offsets[1:])
+
+    def __len__(self):
+        return len(self.sentence_offsets) - 1
+
+    def __getitem__(self, sentence_index):
+        """
+        Returns the word ids of the sentence as an array.
+        """
+        return self.tokens[self.sentence_offsets[sentence_index]:self.sentence_offsets[sentence_index + 1]]
+
+    def __iter__(self):
+        for sentence_index in range(len(self)):
+            yield self[sentence_index]
+
+    def sentence_of(self, position):
+        """
+        Returns the index of the sentence holding the token at position.
+        """
+        return bisect_right(self.sentence_offsets, position) - 1
+
+    def positions(self, start=0, end=None):
+        """
+        Returns the positions of the tokens of sentences start up to end - 1 as an array.
+        """
+        if end is None:
+            end = len(self)
+        return array('i', xrange(self.sentence_offsets[start], self.sentence_offsets[end]))
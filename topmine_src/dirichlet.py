@@ -4,6 +4,10 @@ taken from https://github.com/mimno/Mallet
 """
 from __future__ import division
 import sys, math
+try:
+    import numpy
+except ImportError:
+    numpy = None
 EULER_MASCHERONI = -0.5772156649015328606065121
 PI_SQUARED_OVER_SIX = math.pi * math.pi / 6
 HALF_LOG_TWO_PI = math.log(2 * math.pi) / 2
@@ -20,136 +24,149 @@ DIGAMMA_COEF_10 = 174611 / 6600
 DIGAMMA_LARGE = 9.5
 DIGAMMA_SMALL = 0.000001
 
-def learn_symmetric_concentration(countHistogram, observationLengths, numDimensions, currentValue):
-    currentDigamma = float()
-    largestNonZeroCount = 0
-    nonZeroLengthIndex = [int()]*len(observationLengths)
-
-    index = 0
-    while index < len(countHistogram):
-        if countHistogram[index] > 0:
-            largestNonZeroCount = index
-        index += 1
-
-    denseIndex = 0
-    index = 0
-    while index < len(observationLengths):
-        if observationLengths[index] > 0:
-            nonZeroLengthIndex[denseIndex] = index
-            denseIndex += 1
-        index += 1
-
-    denseIndexSize = denseIndex
+DEFAULT_TOLERANCE = 1e-6
+DIGAMMA_GAP = 20
+
+def learn_symmetric_concentration(countHistogram, observationLengths, numDimensions, currentValue,
+                                  numIterations=200, tolerance=DEFAULT_TOLERANCE):
+    """
+    Fixed point update of the concentration of a symmetric Dirichlet. Stops after
+    numIterations, or as soon as the relative change of the concentration is below
+    tolerance.
+    Unlike the first port, the digamma sum of the observation lengths is advanced
+    from one length to the next, as Mallet does, so the learned concentration differs
+    from the one of earlier versions when a length is 20 or shorter.
+    """
+    countIndices = _non_zero_indices(countHistogram)
+    lengthIndices = _non_zero_indices(observationLengths)
+    if numpy is not None:
+        countHistogram = _truncate_numpy(countHistogram, countIndices)
+        observationLengths = _truncate_numpy(observationLengths, lengthIndices)
 
     iteration = 1
-    while iteration <= 200:
+    while iteration <= numIterations:
         currentParameter = currentValue / numDimensions
-        currentDigamma = 0
-        numerator = 0.0
-
-        index = 1
-        while index <= largestNonZeroCount:
-            currentDigamma += 1.0 / (currentParameter + index - 1)
-            numerator += countHistogram[index] * currentDigamma
-            index += 1
-
-        currentDigamma = 0
-        denominator = 0.0
-        previousLength = 0
-
-        cachedDigamma = digamma(currentValue)
-
-        denseIndex = 0
-        while denseIndex < denseIndexSize:
-            length = nonZeroLengthIndex[denseIndex]
-            if length - previousLength > 20:
-                currentDigamma = digamma(currentValue + length) - cachedDigamma
-            else:
-                index = previousLength
-                while index < length:
-                    currentDigamma += 1.0 / (currentValue + index)
-                    index += 1
-            denominator += currentDigamma * observationLengths[length]
-            denseIndex += 1
-
+        if numpy is not None:
+            numerator = float(_digamma_sums_numpy(currentParameter, countHistogram))
+            denominator = float(_digamma_sums_numpy(currentValue, observationLengths))
+        else:
+            numerator = _digamma_sum(currentParameter, countHistogram, countIndices)
+            denominator = _digamma_sum(currentValue, observationLengths, lengthIndices)
+
+        previousValue = currentValue
         currentValue = currentParameter * numerator / denominator
+        if abs(currentValue - previousValue) <= tolerance * abs(previousValue):
+            break
         iteration += 1
     return currentValue
 
 
-def learn_parameters(parameters, observations, observationLengths):
-    return learn_params(parameters, observations, observationLengths, 1.00001, 1.0, 200)
-
+def learn_parameters(parameters, observations, observationLengths, tolerance=DEFAULT_TOLERANCE):
+    return learn_params(parameters, observations, observationLengths, 1.00001, 1.0, 200, tolerance)
 
-def learn_params(parameters, observations, observationLengths, shape, scale, numIterations):
-    i = int()
-    k = int()
-    parametersSum = 0
-    k = 0
-    while k < len(parameters):
-        parametersSum += parameters[k]
-        k += 1
 
-    oldParametersK = float()
-    currentDigamma = float()
-    denominator = float()
+def learn_params(parameters, observations, observationLengths, shape, scale, numIterations,
+                 tolerance=DEFAULT_TOLERANCE):
+    """
+    Fixed point update of the parameters of an asymmetric Dirichlet, in place. Stops
+    after numIterations, or as soon as the relative change of every parameter is below
+    tolerance. Returns the sum of the parameters.
+    """
+    parametersSum = sum(parameters)
+    lengthIndices = _non_zero_indices(observationLengths)
+    observationIndices = [_non_zero_indices(histogram) for histogram in observations]
 
-    nonZeroLimit = int()
-    nonZeroLimits = [-1]*len(observations)
-
-    histogram = []
-
-    i = 0
-    while i < len(observations):
-        histogram = observations[i]
-
-        k = 0
-        while k < len(histogram):
-            if histogram[k] > 0:
-                nonZeroLimits[i] = k
-            k += 1
-        i += 1
+    if numpy is not None:
+        # rows of observations, cut after the largest non-zero count of all of them
+        limit = max([indices[-1] for indices in observationIndices if indices] or [0]) + 1
+        histograms = numpy.zeros((len(observations), limit))
+        for k, histogram in enumerate(observations):
+            row = numpy.asarray(histogram, dtype=float)[:limit]
+            histograms[k, :len(row)] = row
+        observationLengths = _truncate_numpy(observationLengths, lengthIndices)
 
     iteration = 0
     while iteration < numIterations:
-        denominator = 0
-        currentDigamma = 0
-
-        i = 1
-        while i < len(observationLengths):
-            currentDigamma += 1 / (parametersSum + i - 1)
-            denominator += observationLengths[i] * currentDigamma
-            i += 1
-
-        denominator -= 1 / scale
-        parametersSum = 0
-
-        k = 0
-        while k < len(parameters):
-            nonZeroLimit = nonZeroLimits[k]
-
-            oldParametersK = parameters[k]
-            parameters[k] = 0
-            currentDigamma = 0
-            
-            histogram = observations[k]
-            
-            i = 1
-            while i <= nonZeroLimit:
-                currentDigamma += 1 / (oldParametersK + i - 1)
-                parameters[k] += histogram[i] * currentDigamma
-                i += 1
-            
-            parameters[k] = oldParametersK * (parameters[k] + shape) / denominator
-            parametersSum += parameters[k]
-            k += 1
+        if numpy is not None:
+            denominator = float(_digamma_sums_numpy(parametersSum, observationLengths)) - 1 / scale
+            oldParameters = numpy.asarray(parameters, dtype=float)
+            newParameters = oldParameters * (_digamma_sums_numpy(oldParameters, histograms) + shape) / denominator
+            converged = bool(numpy.all(numpy.abs(newParameters - oldParameters)
+                                       <= tolerance * numpy.abs(oldParameters)))
+            parametersSum = float(newParameters.sum())
+            newParameters = newParameters.tolist()
+            for k in range(len(parameters)):
+                parameters[k] = newParameters[k]
+        else:
+            denominator = _digamma_sum(parametersSum, observationLengths, lengthIndices) - 1 / scale
+            parametersSum = 0
+            converged = True
+            k = 0
+            while k < len(parameters):
+                oldParametersK = parameters[k]
+                parameters[k] = oldParametersK * (
+                    _digamma_sum(oldParametersK, observations[k], observationIndices[k]) + shape) / denominator
+                if abs(parameters[k] - oldParametersK) > tolerance * abs(oldParametersK):
+                    converged = False
+                parametersSum += parameters[k]
+                k += 1
         iteration += 1
+        if converged:
+            break
     if parametersSum < 0.0:
         print parametersSum
         print("sum not valid")
         sys.exit(1)
     return parametersSum
 
+def _non_zero_indices(histogram):
+    """
+    Returns the indices, from 1 on, of the non-zero entries of the histogram.
+    """
+    if numpy is not None:
+        return (numpy.flatnonzero(numpy.asarray(histogram)[1:]) + 1).tolist()
+    return [index for index in range(1, len(histogram)) if histogram[index] > 0]
+
+def _digamma_sum(value, histogram, indices):
+    """
+    Returns the sum over the indices i of histogram[i] * (digamma(value + i) - digamma(value)).
+    The difference is the sum of 1 / (value + j) for j < i, accumulated from one index
+    to the next; over gaps longer than DIGAMMA_GAP it is computed with digamma instead.
+    """
+    total = 0.0
+    currentDigamma = 0.0
+    previousIndex = 0
+    cachedDigamma = None
+    for index in indices:
+        if index - previousIndex > DIGAMMA_GAP:
+            if cachedDigamma is None:
+                cachedDigamma = digamma(value)
+            currentDigamma = digamma(value + index) - cachedDigamma
+        else:
+            j = previousIndex
+            while j < index:
+                currentDigamma += 1.0 / (value + j)
+                j += 1
+        total += histogram[index] * currentDigamma
+        previousIndex = index
+    return total
+
+def _truncate_numpy(histogram, indices):
+    """
+    Returns the histogram as a float array, cut after its last non-zero entry.
+    """
+    return numpy.asarray(histogram, dtype=float)[:(indices[-1] if indices else 0) + 1]
+
+def _digamma_sums_numpy(values, histograms):
+    """
+    Same as _digamma_sum for a scalar value and a histogram, or for a vector of values
+    and one histogram row per value, over all the entries at once.
+    """
+    offsets = numpy.arange(histograms.shape[-1] - 1)
+    values = numpy.asarray(values, dtype=float)[..., numpy.newaxis]
+    digammas = numpy.cumsum(1.0 / (values + offsets), axis=-1)
+    return (histograms[..., 1:] * digammas).sum(axis=-1)
+
 def digamma(z):
     psi = 0.0
     if z < DIGAMMA_SMALL:
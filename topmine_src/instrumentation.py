@@ -0,0 +1,138 @@
+import time
+import json
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class Instrumentation(object):
+    """
+    Collects stage timings and counters of a phrase mining or PhraseLDA run.
+    PhraseMining and PhraseLDA take an ``instrumentation`` argument and use
+    NULL_INSTRUMENTATION when none is given, whose methods do nothing. They only
+    report at the level of stages, mining levels and sweeps, never per token.
+    :param hooks:
+        functions called as ``hook(kind, name, value)`` for every measurement:
+        ``("stage", name, seconds)``, ``("counter", name, increment)``,
+        ``("gauge", name, value)`` and, when memory is traced,
+        ``("snapshot", name, tracemalloc snapshot)`` or, without tracemalloc,
+        ``("memory", name, peak resident set size in kilobytes)``.
+    :param trace_memory:
+        records the traced memory at the end of every stage and takes a
+        tracemalloc snapshot. Where tracemalloc is missing, as on Python 2, records
+        the peak resident set size of the process instead, from
+        resource.getrusage.
+    """
+
+    enabled = True
+
+    def __init__(self, hooks=None, trace_memory=False):
+        self.hooks = list(hooks or [])
+        self.trace_memory = trace_memory
+        if trace_memory:
+            if tracemalloc is None:
+                if resource is None:
+                    raise ImportError("tracing memory requires the tracemalloc or resource module")
+            elif not tracemalloc.is_tracing():
+                tracemalloc.start()
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def stage(self, name):
+        """
+        Returns a context manager timing the stage. A stage entered several times
+        accumulates its time and number of calls.
+        """
+        return _Stage(self, name)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        self._notify("counter", name, value)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+        self._notify("gauge", name, value)
+
+    def _end_stage(self, name, seconds):
+        stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+        self._notify("stage", name, seconds)
+        if not self.trace_memory:
+            return
+        if tracemalloc is not None:
+            stage['memory_current'], stage['memory_peak'] = tracemalloc.get_traced_memory()
+            self._notify("snapshot", name, tracemalloc.take_snapshot())
+        else:
+            # ru_maxrss is in kilobytes on Linux
+            stage['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self._notify("memory", name, stage['peak_rss_kb'])
+
+    def _notify(self, kind, name, value):
+        for hook in self.hooks:
+            hook(kind, name, value)
+
+    def metrics(self):
+        return {'stages': self.stages, 'counters': self.counters, 'gauges': self.gauges}
+
+    def write(self, path):
+        """
+        Stores the stage timings, counters and gauges as JSON.
+        """
+        f = open(path, 'w')
+        json.dump(self.metrics(), f, indent=2, sort_keys=True)
+        f.close()
+
+
+class _Stage(object):
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation._end_stage(self.name, time.time() - self.start)
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+class _NullInstrumentation(object):
+    """
+    Instrumentation that records nothing.
+    """
+
+    enabled = False
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def count(self, name, value=1):
+        pass
+
+    def gauge(self, name, value):
+        pass
+
+
+NULL_INSTRUMENTATION = _NullInstrumentation()
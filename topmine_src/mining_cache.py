@@ -0,0 +1,108 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import cPickle
+import utils
+from phrase_index import PhraseIndex
+
+# bumped whenever the mining output or the stored files change, so that stale
+# entries are never reused
+MINING_CACHE_VERSION = 2
+
+
+class MiningCache(object):
+    """
+    Content-addressed store of phrase mining results. An entry is keyed by a hash
+    of the input corpus, the mining parameters and the stopwords, so that any
+    change to one of them misses the cache. Each entry is a directory holding the
+    binary partitioned docs, the vocabulary, the frequent phrases and the phrase
+    index. Entries are
+    evicted least recently used first once the cache exceeds max_bytes.
+    :param directory:
+        directory holding the entries, created if needed.
+    :param max_bytes:
+        maximum total size of the entries.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, file_name, parameters, stopwords):
+        """
+        Returns the key of the results of mining file_name with the parameters (a
+        dictionary) and the stopwords.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr((MINING_CACHE_VERSION, sorted(parameters.items()), sorted(stopwords))))
+        f = open(file_name, 'rb')
+        for block in iter(lambda: f.read(1 << 20), ""):
+            digest.update(block)
+        f.close()
+        return digest.hexdigest()
+
+    def load(self, key):
+        """
+        Returns the partitioned docs, the vocabulary, the frequent phrases and the
+        phrase index stored under key, or None if there is no such entry.
+        """
+        path = self._entry_path(key)
+        if not os.path.isdir(path):
+            return None
+        partitioned_docs = utils.load_partitioned_corpus(os.path.join(path, "partitioneddocs.bin"))
+        index_vocab = utils.load_vocab(os.path.join(path, "vocab.txt"))
+        f = open(os.path.join(path, "frequent_phrases.pkl"), 'rb')
+        frequent_phrases = cPickle.load(f)
+        f.close()
+        phrase_index = PhraseIndex.load(os.path.join(path, "phrase_index.bin"))
+        # the modification time of an entry is the time it was last used
+        now = time.time()
+        os.utime(path, (now, now))
+        return partitioned_docs, index_vocab, frequent_phrases, phrase_index
+
+    def store(self, key, partitioned_docs, index_vocab, frequent_phrases, phrase_index):
+        """
+        Stores the mining results under key, then evicts the least recently used
+        entries until the cache fits in max_bytes.
+        """
+        path = self._entry_path(key)
+        if os.path.isdir(path):
+            return
+        # the entry is written aside and renamed, so a reader never sees it half written
+        temporary_path = tempfile.mkdtemp(dir=self.directory, prefix=".tmp")
+        utils.store_partitioned_corpus(partitioned_docs, os.path.join(temporary_path, "partitioneddocs.bin"))
+        utils.store_vocab(index_vocab, os.path.join(temporary_path, "vocab.txt"))
+        f = open(os.path.join(temporary_path, "frequent_phrases.pkl"), 'wb')
+        cPickle.dump(frequent_phrases, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        phrase_index.save(os.path.join(temporary_path, "phrase_index.bin"))
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            # stored meanwhile by another run
+            shutil.rmtree(temporary_path, ignore_errors=True)
+        self._evict()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _evict(self):
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+            total_bytes += size
+        entries.sort()
+        for __, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
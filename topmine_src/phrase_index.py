@@ -0,0 +1,326 @@
+import os
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# header of the binary phrase index: magic, version, word and offset item sizes,
+# then the number of nodes, phrases and topics and the size of the vocabulary in
+# bytes. Values are stored in native byte order.
+PHRASE_INDEX_MAGIC = "TMPX"
+PHRASE_INDEX_VERSION = 1
+PHRASE_INDEX_HEADER = struct.Struct("=4sIIIQQQQ")
+
+# arrays of the index in file order, with their type code and their length given
+# the number of nodes, phrases and topics
+_SECTIONS = [
+    ('node_words', 'i', lambda nodes, phrases, topics: nodes),
+    ('parents', 'l', lambda nodes, phrases, topics: nodes),
+    ('subtree_ends', 'l', lambda nodes, phrases, topics: nodes),
+    ('phrase_starts', 'l', lambda nodes, phrases, topics: nodes + 1),
+    ('child_offsets', 'l', lambda nodes, phrases, topics: nodes + 1),
+    ('child_words', 'i', lambda nodes, phrases, topics: nodes - 1),
+    ('child_nodes', 'l', lambda nodes, phrases, topics: nodes - 1),
+    ('phrase_nodes', 'l', lambda nodes, phrases, topics: phrases),
+    ('raw_counts', 'l', lambda nodes, phrases, topics: phrases),
+    ('true_counts', 'l', lambda nodes, phrases, topics: phrases),
+    ('topic_counts', 'i', lambda nodes, phrases, topics: phrases * topics),
+]
+
+def _search_sorted(values, value, start, end):
+    """
+    bisect_left for NumPy arrays, which bisect would compare element by element.
+    """
+    return start + int(values[start:end].searchsorted(value))
+
+
+class PhraseIndex(object):
+    """
+    Dictionary of the mined phrases: a trie over word ids kept in flat arrays, in
+    the spirit of PartitionedCorpus. Nodes are numbered in preorder, so the nodes
+    below a node form a contiguous range, and phrase ids follow the lexicographic
+    order of the word ids, so the phrases starting with a prefix form a range of
+    ids too. Each phrase has its raw count, its true count and, once
+    add_topic_counts was called, its count in every topic.
+    Looking a phrase up costs one binary search among the children of each node
+    on its path. Stored with save, the index is memory-mapped by load when NumPy
+    is available, so a query only reads the pages it touches.
+    :param node_words:
+        word id ending the path of each node, -1 for the root (node 0).
+    :param parents:
+        parent of each node, -1 for the root.
+    :param subtree_ends:
+        the nodes below node ``n`` are ``n + 1`` up to ``subtree_ends[n] - 1``.
+    :param phrase_starts:
+        number of phrases ending at the nodes before each node. Node ``n`` ends
+        the phrase ``phrase_starts[n]`` if ``phrase_starts[n + 1]`` is larger.
+    :param child_offsets:
+        the children of node ``n`` are
+        ``child_nodes[child_offsets[n]:child_offsets[n + 1]]``.
+    :param child_words:
+        word id of each child, in ascending order for every node.
+    :param child_nodes:
+        node of each child.
+    :param phrase_nodes:
+        node ending each phrase.
+    :param raw_counts:
+        raw count of each phrase.
+    :param true_counts:
+        true count of each phrase.
+    :param topic_counts:
+        count of each phrase in each topic, ``num_topics`` values per phrase.
+    :param num_topics:
+        number of topics of topic_counts, 0 when there are no topic counts.
+    :param index_vocab:
+        mapping of integer index to string word.
+    """
+
+    def __init__(self, node_words, parents, subtree_ends, phrase_starts, child_offsets, child_words,
+                 child_nodes, phrase_nodes, raw_counts, true_counts, topic_counts, num_topics, index_vocab):
+        self.node_words = node_words
+        self.parents = parents
+        self.subtree_ends = subtree_ends
+        self.phrase_starts = phrase_starts
+        self.child_offsets = child_offsets
+        self.child_words = child_words
+        self.child_nodes = child_nodes
+        self.phrase_nodes = phrase_nodes
+        self.raw_counts = raw_counts
+        self.true_counts = true_counts
+        self.topic_counts = topic_counts
+        self.num_topics = num_topics
+        self.index_vocab = index_vocab
+        self.vocab = dict((word, word_id) for word_id, word in enumerate(index_vocab))
+        self.num_nodes = len(node_words)
+        self.num_phrases = len(phrase_nodes)
+
+    @classmethod
+    def from_counters(cls, hash_counter, true_counter, index_vocab):
+        """
+        Builds the index of the phrases of hash_counter, the raw counts of the
+        frequent phrases as tuples of word ids, with their true counts from
+        true_counter.
+        """
+        phrases = []
+        for phrase in hash_counter:
+            if not isinstance(phrase, tuple):
+                raise ValueError("the phrase index requires phrases of word ids")
+            if len(phrase) > 0:
+                phrases.append(phrase)
+        # in lexicographic order a phrase comes right after the phrases sharing its
+        # prefix, so the trie is built in preorder along a single path
+        phrases.sort()
+
+        node_words = array('i', [-1])
+        parents = array('l', [-1])
+        phrase_nodes = array('l')
+        path = []
+        for phrase in phrases:
+            common = 0
+            while common < len(path) and common < len(phrase) and node_words[path[common]] == phrase[common]:
+                common += 1
+            del path[common:]
+            for word in phrase[common:]:
+                parents.append(path[-1] if path else 0)
+                path.append(len(node_words))
+                node_words.append(word)
+            phrase_nodes.append(path[-1])
+        num_nodes = len(node_words)
+
+        subtree_ends = array('l', range(1, num_nodes + 1))
+        for node in range(num_nodes - 1, 0, -1):
+            parent = parents[node]
+            if subtree_ends[node] > subtree_ends[parent]:
+                subtree_ends[parent] = subtree_ends[node]
+
+        phrase_starts = array('l', [0]) * (num_nodes + 1)
+        for node in phrase_nodes:
+            phrase_starts[node + 1] = 1
+        for node in range(num_nodes):
+            phrase_starts[node + 1] += phrase_starts[node]
+
+        # children are created in ascending order of their word, so the children of
+        # every node end up sorted
+        child_offsets = array('l', [0]) * (num_nodes + 1)
+        for node in range(1, num_nodes):
+            child_offsets[parents[node] + 1] += 1
+        for node in range(num_nodes):
+            child_offsets[node + 1] += child_offsets[node]
+        child_words = array('i', [0]) * (num_nodes - 1)
+        child_nodes = array('l', [0]) * (num_nodes - 1)
+        positions = array('l', child_offsets)
+        for node in range(1, num_nodes):
+            position = positions[parents[node]]
+            child_words[position] = node_words[node]
+            child_nodes[position] = node
+            positions[parents[node]] += 1
+
+        raw_counts = array('l', (hash_counter[phrase] for phrase in phrases))
+        true_counts = array('l', (true_counter.get(phrase, 0) for phrase in phrases))
+        return cls(node_words, parents, subtree_ends, phrase_starts, child_offsets, child_words,
+                   child_nodes, phrase_nodes, raw_counts, true_counts, array('i'), 0, index_vocab)
+
+    def add_topic_counts(self, topic_model):
+        """
+        Counts the phrases of each topic of a PhraseLDA model that has run, whose
+        vocabulary must be the one of the index. Phrases missing from the index,
+        the infrequent words, are not counted.
+        """
+        num_topics = topic_model.num_topics
+        topic_counts = array('i', [0]) * (self.num_phrases * num_topics)
+        tokens = topic_model.corpus.tokens
+        phrase_offsets = topic_model.corpus.phrase_offsets
+        phrase_ids = {}
+        for phrase_index, phrase_topic in enumerate(topic_model.phrase_topics):
+            phrase = tuple(tokens[phrase_offsets[phrase_index]:phrase_offsets[phrase_index + 1]])
+            if phrase in phrase_ids:
+                phrase_id = phrase_ids[phrase]
+            else:
+                phrase_id = phrase_ids[phrase] = self.lookup(phrase)
+            if phrase_id is not None:
+                topic_counts[phrase_id * num_topics + phrase_topic] += 1
+        self.topic_counts = topic_counts
+        self.num_topics = num_topics
+
+    def __len__(self):
+        return self.num_phrases
+
+    def _node(self, phrase):
+        node = 0
+        child_offsets = self.child_offsets
+        child_words = self.child_words
+        search = bisect_left if isinstance(child_words, array) else _search_sorted
+        for word in phrase:
+            start = child_offsets[node]
+            end = child_offsets[node + 1]
+            position = search(child_words, word, start, end)
+            if position == end or child_words[position] != word:
+                return None
+            node = self.child_nodes[position]
+        return node
+
+    def lookup(self, phrase):
+        """
+        Returns the id of the phrase, a sequence of word ids, or None if it was not
+        mined.
+        """
+        node = self._node(phrase)
+        if node is None or self.phrase_starts[node + 1] == self.phrase_starts[node]:
+            return None
+        return int(self.phrase_starts[node])
+
+    def prefix(self, prefix):
+        """
+        Returns the ids of the phrases starting with prefix, a sequence of word ids,
+        in lexicographic order. The prefix itself is included if it is a phrase.
+        """
+        node = self._node(prefix)
+        if node is None:
+            return xrange(0)
+        return xrange(int(self.phrase_starts[node]), int(self.phrase_starts[self.subtree_ends[node]]))
+
+    def word_ids(self, words):
+        """
+        Returns the word ids of a string of space separated words, or None if one
+        of them is not in the vocabulary.
+        """
+        word_ids = []
+        for word in words.split():
+            word_id = self.vocab.get(word)
+            if word_id is None:
+                return None
+            word_ids.append(word_id)
+        return tuple(word_ids)
+
+    def phrase(self, phrase_id):
+        """
+        Returns the phrase as a tuple of word ids.
+        """
+        words = []
+        node = self.phrase_nodes[phrase_id]
+        while node > 0:
+            words.append(int(self.node_words[node]))
+            node = self.parents[node]
+        words.reverse()
+        return tuple(words)
+
+    def words(self, phrase_id):
+        """
+        Returns the phrase as a string of space separated words.
+        """
+        return " ".join(self.index_vocab[word] for word in self.phrase(phrase_id))
+
+    def raw_count(self, phrase_id):
+        return int(self.raw_counts[phrase_id])
+
+    def true_count(self, phrase_id):
+        return int(self.true_counts[phrase_id])
+
+    def topic_count(self, phrase_id):
+        """
+        Returns the count of the phrase in every topic, an empty list when the index
+        has no topic counts.
+        """
+        start = phrase_id * self.num_topics
+        return [int(count) for count in self.topic_counts[start:start + self.num_topics]]
+
+    def save(self, path):
+        """
+        Stores the index in a binary file: a small header followed by the arrays,
+        each aligned on 8 bytes, and the vocabulary. The file is written aside and
+        renamed, so an index memory-mapped from the same path stays valid.
+        """
+        vocab = "\n".join(self.index_vocab)
+        temporary_path = path + ".tmp"
+        f = open(temporary_path, 'wb')
+        f.write(PHRASE_INDEX_HEADER.pack(
+            PHRASE_INDEX_MAGIC, PHRASE_INDEX_VERSION, array('i').itemsize, array('l').itemsize,
+            self.num_nodes, self.num_phrases, self.num_topics, len(vocab)))
+        for name, typecode, __ in _SECTIONS:
+            f.write("\0" * (-f.tell() % 8))
+            array(typecode, getattr(self, name)).tofile(f)
+        f.write(vocab)
+        f.close()
+        os.rename(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads an index stored by save. When NumPy is available the arrays are
+        read-only views of the memory-mapped file, otherwise they are read in bulk
+        into arrays.
+        """
+        f = open(path, 'rb')
+        header = f.read(PHRASE_INDEX_HEADER.size)
+        magic, version, word_size, offset_size, num_nodes, num_phrases, num_topics, vocab_size = \
+            PHRASE_INDEX_HEADER.unpack(header)
+        if magic != PHRASE_INDEX_MAGIC or version != PHRASE_INDEX_VERSION:
+            raise ValueError("{0} is not a phrase index file".format(path))
+        if word_size != array('i').itemsize or offset_size != array('l').itemsize:
+            raise ValueError("{0} was written on a platform with different integer sizes".format(path))
+
+        if numpy is not None:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        arrays = {}
+        position = PHRASE_INDEX_HEADER.size
+        for name, typecode, length in _SECTIONS:
+            position += -position % 8
+            length = length(num_nodes, num_phrases, num_topics)
+            if numpy is not None:
+                arrays[name] = numpy.frombuffer(buf, numpy.dtype(typecode), length, position)
+            else:
+                f.seek(position)
+                arrays[name] = array(typecode)
+                arrays[name].fromfile(f, length)
+            position += length * array(typecode).itemsize
+        f.seek(position)
+        vocab = f.read(vocab_size)
+        f.close()
+        index_vocab = vocab.split("\n") if vocab_size > 0 else []
+        return cls(num_topics=num_topics, index_vocab=index_vocab, **arrays)
@@ -1,9 +1,89 @@
 from __future__ import division
 import dirichlet
 import random
-import utils
 import math
+import copy
+import heapq
+import multiprocessing
+import cPickle
+import os
+from array import array
 from collections import Counter
+from corpus import PartitionedCorpus
+from instrumentation import NULL_INSTRUMENTATION
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _sweep_shard(connection, shard):
+    """
+    Worker loop of the parallel (AD-LDA) mode. The shard samples its own documents
+    against a local copy of the topic/word counts, replies with the count changes of
+    the sweep and then folds in the changes made by all the workers. Every sweep is
+    seeded by the parent, so a run only depends on the parent's random state.
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        command = message[0]
+        if command == "sweep":
+            shard.alpha, shard.beta, shard.beta_sum, seed = message[1:]
+            random.seed(seed)
+            previous_topics = shard.phrase_topics[shard.first_phrase():shard.last_phrase()]
+            shard._run_sweep()
+            deltas = shard._count_deltas(previous_topics)
+            connection.send(deltas)
+            global_deltas = connection.recv()
+            for key, delta in deltas.items():
+                global_deltas[key] -= delta
+            shard._apply_count_deltas(global_deltas)
+        elif command == "document_log_likelihood":
+            shard.alpha, shard.alpha_sum = message[1:]
+            connection.send(shard._document_log_likelihood())
+        elif command == "document_topics":
+            connection.send(shard.n_d_t_words[shard.document_start:shard.document_end])
+        elif command == "assignments":
+            connection.send((shard.phrase_topics[shard.first_phrase():shard.last_phrase()],
+                             shard.n_d_t_phrases[shard.document_start:shard.document_end],
+                             shard.n_d_t_words[shard.document_start:shard.document_end]))
+    connection.close()
+
+
+def _flatten_counts(matrix):
+    """
+    Returns the rows of a count matrix, lists, arrays or a NumPy array, back to back
+    in an array of ints.
+    """
+    values = array('i')
+    for row in matrix:
+        values.extend(int(count) for count in row)
+    return values
+
+def _unflatten_counts(values, matrix):
+    """
+    Copies the values returned by _flatten_counts back into the rows of matrix.
+    """
+    start = 0
+    for row in matrix:
+        for index in range(len(row)):
+            row[index] = values[start + index]
+        start += len(row)
+
+def _shared_counts(*shape):
+    """
+    Returns a flat array of zero counts and a NumPy view of it with the given shape.
+    """
+    size = 1
+    for dimension in shape:
+        size *= dimension
+    values = array('i', [0]) * size
+    if size == 0:
+        return values, numpy.zeros(shape, dtype=numpy.intc)
+    return values, numpy.frombuffer(values, dtype=numpy.intc).reshape(shape)
 
 
 class PhraseLDA(object):
@@ -12,7 +92,8 @@ class PhraseLDA(object):
     Topic Modeling using lda with collapsed gibbs sampling on "bag-of-phrases".
     :param partitioned_docs:
         List of documents, where each document is partitioned into a list of 
-        phrases. 
+        phrases, or a ``PartitionedCorpus``. Either way the corpus and the
+        topic assignments are kept in flat arrays.
     :param index_vocab:
         Mapping of integer index to string word.
     :param num_topics:
@@ -34,14 +115,60 @@ class PhraseLDA(object):
     :param optimization_burnin:
         Number of gibbs sampling iterations before hyperparameter optimization
         starts.
+    :param sampler:
+        ``"python"`` samples every topic in a plain loop. ``"numpy"`` keeps the
+        counts in NumPy arrays and computes the topic distribution of a phrase
+        as one vectorized product over the topic axis, which pays off when
+        there are many topics. Requires NumPy. ``"sparse"`` splits the
+        conditional into a smoothing, a document-topic and a topic-word bucket
+        (SparseLDA), so the cost of a phrase grows with the number of topics
+        its document and words actually use instead of ``num_topics``.
+    :param workers:
+        Number of processes sampling in parallel. Documents are split into one
+        shard per worker, each worker samples against a local copy of the
+        topic/word counts and the copies are synchronized after every
+        iteration (approximate distributed LDA).
+    :param checkpoint_path:
+        File the sampling state is written to every ``checkpoint_iterations``
+        iterations, so that an interrupted run can be resumed with
+        ``run(checkpoint_path)``. Set to ``None`` for no checkpoints.
+    :param checkpoint_iterations:
+        Number of iterations between two checkpoints.
+    :param likelihood_iterations:
+        Computes the collapsed log-likelihood of the topic assignments every
+        ``likelihood_iterations`` iterations and appends ``(iteration,
+        log_likelihood)`` to ``log_likelihoods``. Set to ``None`` to skip it.
+    :param convergence_tolerance:
+        Stops sampling once the burn-in is over and the relative improvement of
+        the log-likelihood between two computations falls below this value. Set
+        to ``None`` to always run ``iterations`` iterations.
+    :param top_phrases:
+        Number of most frequent phrases of each topic returned by ``run``. They
+        are selected with a heap over integer phrase ids instead of sorting
+        every phrase of the topic. Set to ``None`` to return all of them.
+    :param instrumentation:
+        An ``instrumentation.Instrumentation`` receiving the time spent
+        initializing, sweeping, optimizing, computing the log-likelihood and
+        checkpointing, the number of sampled phrases and the log-likelihoods.
+        Nothing is measured when it is ``None``.
     """
 
     def __init__(self, partitioned_docs, index_vocab, 
                  num_topics=5, alpha=4, beta=0.01, iterations=1000,
-                 optimization_iterations=100, optimization_burnin=50):
+                 optimization_iterations=100, optimization_burnin=50,
+                 sampler="python", workers=1, checkpoint_path=None,
+                 checkpoint_iterations=100, likelihood_iterations=None,
+                 convergence_tolerance=None, top_phrases=None, instrumentation=None):
         # initialize corpus
-        self.documents = partitioned_docs
-        self.num_documents = len(partitioned_docs)
+        if not isinstance(partitioned_docs, PartitionedCorpus):
+            partitioned_docs = PartitionedCorpus.from_partitioned_docs(partitioned_docs)
+        # the samplers read the corpus element by element, which is slow on NumPy arrays
+        self.corpus = partitioned_docs.to_arrays()
+        self.num_documents = self.corpus.num_documents
+        self.num_phrases = self.corpus.num_phrases
+        # documents sampled by this instance; a worker only owns a contiguous range
+        self.document_start = 0
+        self.document_end = self.num_documents
         self.index_vocab = index_vocab
         self.num_words = len(index_vocab)
         self.num_topics = num_topics
@@ -57,68 +184,98 @@ class PhraseLDA(object):
         self.optimization_iterations = optimization_iterations
         self.optimization_burnin = optimization_burnin
 
+        if sampler not in ("python", "numpy", "sparse"):
+            raise ValueError("unknown sampler: {0}".format(sampler))
+        if sampler == "numpy" and numpy is None:
+            raise ImportError("the numpy sampler requires NumPy")
+        self.sampler = sampler
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_iterations = checkpoint_iterations
+        self.likelihood_iterations = likelihood_iterations
+        self.convergence_tolerance = convergence_tolerance
+        if convergence_tolerance is not None and likelihood_iterations is None:
+            raise ValueError("convergence_tolerance requires likelihood_iterations")
+        self.log_likelihoods = []
+        self.top_phrases = top_phrases
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+
     def _initialize(self):
         self._init_documents()
 
-        # Array stores per topic counts
-        self.n_t = [0] * self.num_topics
-
-        # 2d array that stores document/topic counts by phrase, and word respectively
-        self.n_d_t_phrases = [[0] * self.num_topics for __ in range(self.num_documents)]
-        self.n_d_t_words = [[0] * self.num_topics for __ in range(self.num_documents)]
-
-        # 2d array that stores topic/word counts
-        self.n_t_w = [[0] * self.num_words for __ in range(self.num_topics)]
+        self._init_counts()
 
         self._init_documents_topics()
 
-        self._init_histogram()
-
-    def _init_documents(self):
-        self.documents_words = []
-
-        self.max_documents_phrases_count = 0
-        self.max_documents_words_count = 0
+        if self.sampler == "sparse":
+            self._init_sparse_topics()
 
-        for document in self.documents:
-            document_words = []
+        self._init_histogram()
 
-            document_words_count = 0
+    def _init_counts(self):
+        if self.sampler == "numpy":
+            # the counts live in flat arrays, which _sweep_numpy updates one count at
+            # a time without the overhead of NumPy scalars, and are read through
+            # NumPy views sharing their memory
+            self.n_t_values, self.n_t = _shared_counts(self.num_topics)
+            self.n_d_t_phrases_values, self.n_d_t_phrases = _shared_counts(self.num_documents, self.num_topics)
+            self.n_d_t_words_values, self.n_d_t_words = _shared_counts(self.num_documents, self.num_topics)
+            self.n_t_w_values, self.n_t_w = _shared_counts(self.num_topics, self.num_words)
+        else:
+            # Array stores per topic counts
+            self.n_t = [0] * self.num_topics
 
-            for phrase in document:
-                for word in phrase:
-                    document_words.append(word)
+            # 2d array that stores document/topic counts by phrase, and word respectively
+            self.n_d_t_phrases = [array('i', [0]) * self.num_topics for __ in range(self.num_documents)]
+            self.n_d_t_words = [array('i', [0]) * self.num_topics for __ in range(self.num_documents)]
 
-                    document_words_count += 1
+            # 2d array that stores topic/word counts
+            self.n_t_w = [array('i', [0]) * self.num_words for __ in range(self.num_topics)]
 
-            self.documents_words.append(document_words)
+    def _init_documents(self):
+        self.max_documents_phrases_count = 0
+        self.max_documents_words_count = 0
 
-            self.max_documents_phrases_count = max(self.max_documents_phrases_count, len(document))
-            self.max_documents_words_count = max(self.max_documents_words_count, document_words_count)
+        for document_index in range(self.num_documents):
+            self.max_documents_phrases_count = max(self.max_documents_phrases_count,
+                                                   len(self.corpus.phrases_of(document_index)))
+            self.max_documents_words_count = max(self.max_documents_words_count,
+                                                 self.corpus.document_length(document_index))
 
     def _init_documents_topics(self):
         # we assign a random topic to each phrase in the document
-        self.documents_phrases_topic = []
+        self.phrase_topics = array('i', [0]) * self.num_phrases
+        tokens = self.corpus.tokens
+        phrase_offsets = self.corpus.phrase_offsets
 
-        for document_index, document in enumerate(self.documents):
-            document_phrases_topic = []
-            for phrase_index, phrase in enumerate(document):
+        for document_index in range(self.num_documents):
+            for phrase_index in self.corpus.phrases_of(document_index):
                 document_phrase_topic = random.randint(0,self.num_topics-1)
-                document_phrases_topic.append(document_phrase_topic)
+                self.phrase_topics[phrase_index] = document_phrase_topic
+                start = phrase_offsets[phrase_index]
+                end = phrase_offsets[phrase_index + 1]
                 
                 # Increase counts
-                self.n_t[document_phrase_topic] += len(phrase)
+                self.n_t[document_phrase_topic] += end - start
                 self.n_d_t_phrases[document_index][document_phrase_topic] += 1
-                self.n_d_t_words[document_index][document_phrase_topic] += len(phrase)
-                for word_index in phrase:
+                self.n_d_t_words[document_index][document_phrase_topic] += end - start
+                for word_index in tokens[start:end]:
                     self.n_t_w[document_phrase_topic][word_index] += 1
-            self.documents_phrases_topic.append(document_phrases_topic)
 
+    def _init_sparse_topics(self):
+        # topics with a non-zero count for each word, and the distinct phrase lengths
+        self.word_topics = [set() for __ in range(self.num_words)]
+        for topic_index in range(self.num_topics):
+            for word_index, count in enumerate(self.n_t_w[topic_index]):
+                if count > 0:
+                    self.word_topics[word_index].add(topic_index)
+        self.phrase_lengths = set(self.corpus.phrase_length(phrase_index)
+                                  for phrase_index in range(self.num_phrases))
 
     def _init_histogram(self):
         self.document_length_histogram = [0] * (self.max_documents_words_count + 1)
-        for document in self.documents_words:
-            self.document_length_histogram[len(document)] += 1
+        for document_index in range(self.num_documents):
+            self.document_length_histogram[self.corpus.document_length(document_index)] += 1
         self._init_topic_document_histogram()
 
     def _init_topic_document_histogram(self):
@@ -134,64 +291,595 @@ class PhraseLDA(object):
                 break
         return topic
 
-    def _calculate_topic_probabilities(self, document_index, phrase_index):
+    def _calculate_topic_probabilities(self, document_index, phrase):
+        # phrase holds the word ids of the phrase
+        alpha = self.alpha
+        beta = self.beta
+        beta_sum = self.beta_sum
+        n_t = self.n_t
+        n_t_w = self.n_t_w
+        n_d_t_phrases = self.n_d_t_phrases[document_index]
         topic_probabilities = []
         for topic_index in range(self.num_topics):
-            left = self.alpha[topic_index] + self.n_d_t_phrases[document_index][topic_index]
+            left = alpha[topic_index] + n_d_t_phrases[topic_index]
             right = 1.0
-            for word_index in self.documents[document_index][phrase_index]:
-                right *= (self.beta + self.n_t_w[topic_index][word_index]) / (self.beta_sum + (self.n_t[topic_index]))
+            n_w = n_t_w[topic_index]
+            denominator = beta_sum + n_t[topic_index]
+            for word_index in phrase:
+                right *= (beta + n_w[word_index]) / denominator
             topic_probability = left * right
             topic_probabilities.append(topic_probability)
         return topic_probabilities
 
+    def _should_checkpoint(self, iterations):
+        if self.checkpoint_path is None:
+            return False
+        return ((iterations+1) % self.checkpoint_iterations) == 0
+
+    def _should_compute_likelihood(self, iterations):
+        if self.likelihood_iterations is None:
+            return False
+        return ((iterations+1) % self.likelihood_iterations) == 0
+
+    def _has_converged(self, iterations):
+        if self.convergence_tolerance is None or len(self.log_likelihoods) < 2:
+            return False
+        if (iterations+1) <= self.optimization_burnin:
+            return False
+        previous = self.log_likelihoods[-2][1]
+        current = self.log_likelihoods[-1][1]
+        return (current - previous) / abs(previous) < self.convergence_tolerance
+
     def _should_optimize(self, iterations):
         if self.optimization_iterations is None:
-            return false
+            return False
         iterations_condition = ((iterations+1) % self.optimization_iterations) == 0
         burnin_condition = ((iterations+1) > self.optimization_burnin)
         return iterations_condition and burnin_condition
 
 
-    def run(self):
-        self._initialize()        
-        for iteration in range(self.iterations):
+    def run(self, checkpoint=None):
+        """
+        Runs the Gibbs sampler, or resumes it from the state stored in the checkpoint
+        file if one is given.
+        """
+        instrumentation = self.instrumentation
+        with instrumentation.stage("lda.initialize"):
+            if checkpoint is None:
+                self._initialize()        
+                start_iteration = 0
+            else:
+                start_iteration = self._load_checkpoint(checkpoint)
+            if self.workers > 1:
+                self._start_workers()
+        for iteration in range(start_iteration, self.iterations):
             if iteration % 100 == 0:
                 print "iteration", iteration
 
-            for document_index, document in enumerate(self.documents):
-                for phrase_index, phrase in enumerate(document):
-                    document_phrase_topic = self.documents_phrases_topic[document_index][phrase_index]
+            with instrumentation.stage("lda.sweep"):
+                if self.workers > 1:
+                    self._sweep_parallel()
+                else:
+                    self._run_sweep()
+            instrumentation.count("lda.sampled_phrases", self.num_phrases)
 
-                    # reduce counts for sampling
-                    self.n_t[document_phrase_topic] -= len(phrase)
-                    self.n_d_t_phrases[document_index][document_phrase_topic] -= 1
-                    self.n_d_t_words[document_index][document_phrase_topic] -= len(phrase)
-                    for word_index in phrase:
-                        self.n_t_w[document_phrase_topic][word_index] -= 1
+            if self._should_optimize(iteration):
+                with instrumentation.stage("lda.optimize"):
+                    if self.workers > 1:
+                        self._collect_document_topics()
+                    self._optimize_hyperparameters()
 
-                    sampling_probabilities = self._calculate_topic_probabilities(document_index, phrase_index)
-                    document_phrase_topic = self._sample_topic(sampling_probabilities)
+            converged = False
+            if self._should_compute_likelihood(iteration):
+                with instrumentation.stage("lda.log_likelihood"):
+                    if self.workers > 1:
+                        log_likelihood = self._collect_log_likelihood()
+                    else:
+                        log_likelihood = self.log_likelihood()
+                self.log_likelihoods.append((iteration + 1, log_likelihood))
+                instrumentation.gauge("lda.log_likelihood", log_likelihood)
+                converged = self._has_converged(iteration)
+                if converged:
+                    print "converged at iteration", iteration + 1
 
-                    self.documents_phrases_topic[document_index][phrase_index] = document_phrase_topic
-                    
-                    self.n_t[document_phrase_topic] += len(phrase)
-                    self.n_d_t_phrases[document_index][document_phrase_topic] += 1
-                    self.n_d_t_words[document_index][document_phrase_topic] += len(phrase)
-                    for word_index in phrase:
-                        self.n_t_w[document_phrase_topic][word_index] += 1
+            if self._should_checkpoint(iteration):
+                with instrumentation.stage("lda.checkpoint"):
+                    if self.workers > 1:
+                        self._collect_assignments()
+                    self.save_checkpoint(self.checkpoint_path, iteration + 1)
+            if converged:
+                break
+        if self.workers > 1:
+            self._collect_assignments()
+            self._stop_workers()
 
-            if self._should_optimize(iteration):
-                self._optimize_hyperparameters()
+        if instrumentation.enabled and "lda.sweep" in instrumentation.stages:
+            sweep = instrumentation.stages["lda.sweep"]
+            if sweep['seconds'] > 0:
+                instrumentation.gauge("lda.sampled_phrases_per_second",
+                                      sweep['calls'] * self.num_phrases / sweep['seconds'])
         
-        topics = self._getTopics()
-        return self.documents_phrases_topic, self._getMostFrequentPhrasalTopics(topics)
+        with instrumentation.stage("lda.topics"):
+            topics, phrases = self._getTopics()
+            most_frequent_topics = self._getMostFrequentPhrasalTopics(topics, phrases)
+        return self.documents_phrases_topic, most_frequent_topics
+
+    @property
+    def documents_phrases_topic(self):
+        """
+        Topic of each phrase, split by document.
+        """
+        return self.corpus.split_by_document(self.phrase_topics)
+
+    def first_phrase(self):
+        return self.corpus.document_offsets[self.document_start]
+
+    def last_phrase(self):
+        return self.corpus.document_offsets[self.document_end]
+
+    def _run_sweep(self):
+        if self.sampler == "numpy":
+            self._sweep_numpy()
+        elif self.sampler == "sparse":
+            self._sweep_sparse()
+        else:
+            self._sweep()
+
+    def _start_workers(self):
+        """
+        Forks one worker per shard of contiguous documents.
+        """
+        self.shard_bounds = []
+        self.connections = []
+        self.processes = []
+        shard_size = -(-self.num_documents // self.workers)
+        for start in range(0, self.num_documents, shard_size):
+            end = min(start + shard_size, self.num_documents)
+            # the forked worker gets its own copy of the counts and assignments
+            shard = copy.copy(self)
+            shard.workers = 1
+            shard.document_start = start
+            shard.document_end = end
+
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_sweep_shard, args=(child_connection, shard))
+            process.daemon = True
+            process.start()
+            child_connection.close()
+            self.shard_bounds.append((start, end))
+            self.connections.append(connection)
+            self.processes.append(process)
+
+    def _sweep_parallel(self):
+        """
+        Runs one sweep on every shard and merges the count changes into the global
+        topic/word counts, which are then sent back to all the workers.
+        """
+        for connection in self.connections:
+            connection.send(("sweep", self.alpha, self.beta, self.beta_sum, random.getrandbits(64)))
+        global_deltas = Counter()
+        for connection in self.connections:
+            global_deltas.update(connection.recv())
+        for connection in self.connections:
+            connection.send(global_deltas)
+        self._apply_count_deltas(global_deltas)
+
+    def _collect_document_topics(self):
+        for connection in self.connections:
+            connection.send(("document_topics",))
+        for (start, end), connection in zip(self.shard_bounds, self.connections):
+            for document_index, row in enumerate(connection.recv(), start):
+                self.n_d_t_words[document_index] = row
+
+    def _collect_log_likelihood(self):
+        for connection in self.connections:
+            connection.send(("document_log_likelihood", self.alpha, self.alpha_sum))
+        document_log_likelihood = sum(connection.recv() for connection in self.connections)
+        return document_log_likelihood + self._topic_log_likelihood()
+
+    def _collect_assignments(self):
+        """
+        Copies the topic assignments and document/topic counts of every shard.
+        """
+        for connection in self.connections:
+            connection.send(("assignments",))
+        for (start, end), connection in zip(self.shard_bounds, self.connections):
+            phrase_topics, n_d_t_phrases, n_d_t_words = connection.recv()
+            first_phrase = self.corpus.document_offsets[start]
+            self.phrase_topics[first_phrase:first_phrase + len(phrase_topics)] = phrase_topics
+            for document_index in range(start, end):
+                self.n_d_t_phrases[document_index] = n_d_t_phrases[document_index - start]
+                self.n_d_t_words[document_index] = n_d_t_words[document_index - start]
+
+    def _stop_workers(self):
+        for connection in self.connections:
+            connection.send(None)
+        for process in self.processes:
+            process.join()
+
+    def save_checkpoint(self, path, iteration):
+        """
+        Stores the sampling state reached before the given iteration: the topic
+        assignments, the count arrays, the hyperparameters and the random state. The
+        arrays are stored as raw bytes. The file is replaced atomically, so a crash
+        while writing keeps the previous checkpoint.
+        """
+        checkpoint = {
+            'iteration': iteration,
+            'num_topics': self.num_topics,
+            'num_words': self.num_words,
+            'num_phrases': self.num_phrases,
+            'alpha': list(self.alpha),
+            'alpha_sum': self.alpha_sum,
+            'beta': self.beta,
+            'beta_sum': self.beta_sum,
+            'random_state': random.getstate(),
+            'log_likelihoods': self.log_likelihoods,
+            'phrase_topics': self.phrase_topics.tostring(),
+            'n_t': _flatten_counts([self.n_t]).tostring(),
+            'n_t_w': _flatten_counts(self.n_t_w).tostring(),
+            'n_d_t_phrases': _flatten_counts(self.n_d_t_phrases).tostring(),
+            'n_d_t_words': _flatten_counts(self.n_d_t_words).tostring(),
+        }
+        temporary_path = path + ".tmp"
+        f = open(temporary_path, 'wb')
+        cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(temporary_path, path)
+
+    def _load_checkpoint(self, path):
+        """
+        Restores the state stored by save_checkpoint and returns the iteration to
+        resume from.
+        """
+        f = open(path, 'rb')
+        checkpoint = cPickle.load(f)
+        f.close()
+        if (checkpoint['num_topics'] != self.num_topics or checkpoint['num_words'] != self.num_words
+                or checkpoint['num_phrases'] != self.num_phrases):
+            raise ValueError("{0} does not match this corpus and number of topics".format(path))
+
+        self._init_documents()
+        self._init_counts()
+
+        self.phrase_topics = array('i')
+        self.phrase_topics.fromstring(checkpoint['phrase_topics'])
+        for name, matrix in (('n_t', [self.n_t]), ('n_t_w', self.n_t_w),
+                             ('n_d_t_phrases', self.n_d_t_phrases), ('n_d_t_words', self.n_d_t_words)):
+            values = array('i')
+            values.fromstring(checkpoint[name])
+            _unflatten_counts(values, matrix)
+
+        self.alpha = checkpoint['alpha']
+        self.alpha_sum = checkpoint['alpha_sum']
+        self.beta = checkpoint['beta']
+        self.beta_sum = checkpoint['beta_sum']
+        random.setstate(checkpoint['random_state'])
+        self.log_likelihoods = checkpoint['log_likelihoods']
+
+        if self.sampler == "sparse":
+            self._init_sparse_topics()
+        self._init_histogram()
+        return checkpoint['iteration']
+
+    def _count_deltas(self, previous_topics):
+        """
+        Returns the changes of the topic/word counts since the phrases of this
+        instance's documents had the topics previous_topics, keyed by (topic, word).
+        """
+        deltas = Counter()
+        first_phrase = self.first_phrase()
+        for phrase_index in range(first_phrase, self.last_phrase()):
+            previous_topic = previous_topics[phrase_index - first_phrase]
+            topic = self.phrase_topics[phrase_index]
+            if topic != previous_topic:
+                for word_index in self.corpus.phrase(phrase_index):
+                    deltas[(previous_topic, word_index)] -= 1
+                    deltas[(topic, word_index)] += 1
+        return deltas
+
+    def _apply_count_deltas(self, deltas):
+        for (topic_index, word_index), delta in deltas.items():
+            if delta == 0:
+                continue
+            self.n_t[topic_index] += delta
+            self.n_t_w[topic_index][word_index] += delta
+            if self.sampler == "sparse":
+                if self.n_t_w[topic_index][word_index] > 0:
+                    self.word_topics[word_index].add(topic_index)
+                else:
+                    self.word_topics[word_index].discard(topic_index)
+
+    def _sweep(self):
+        """
+        Resamples the topic of every phrase in the corpus once.
+        """
+        tokens = self.corpus.tokens
+        phrase_offsets = self.corpus.phrase_offsets
+        document_offsets = self.corpus.document_offsets
+        for document_index in range(self.document_start, self.document_end):
+            n_d_t_phrases = self.n_d_t_phrases[document_index]
+            n_d_t_words = self.n_d_t_words[document_index]
+            for phrase_index in range(document_offsets[document_index], document_offsets[document_index + 1]):
+                document_phrase_topic = self.phrase_topics[phrase_index]
+                # a tuple boxes the word ids once, instead of once per topic
+                phrase = tuple(tokens[phrase_offsets[phrase_index]:phrase_offsets[phrase_index + 1]])
+
+                # reduce counts for sampling
+                self.n_t[document_phrase_topic] -= len(phrase)
+                n_d_t_phrases[document_phrase_topic] -= 1
+                n_d_t_words[document_phrase_topic] -= len(phrase)
+                for word_index in phrase:
+                    self.n_t_w[document_phrase_topic][word_index] -= 1
+
+                sampling_probabilities = self._calculate_topic_probabilities(document_index, phrase)
+                document_phrase_topic = self._sample_topic(sampling_probabilities)
+
+                self.phrase_topics[phrase_index] = document_phrase_topic
+                
+                self.n_t[document_phrase_topic] += len(phrase)
+                n_d_t_phrases[document_phrase_topic] += 1
+                n_d_t_words[document_phrase_topic] += len(phrase)
+                for word_index in phrase:
+                    self.n_t_w[document_phrase_topic][word_index] += 1
+
+    def _sweep_numpy(self):
+        """
+        Same as _sweep, with the topic distribution of each phrase computed as a single
+        vectorized product over the topic axis and sampled through its cumulative sum.
+        The counts are updated through their flat arrays, a phrase costs a handful of
+        NumPy operations whatever the number of topics.
+        """
+        alpha = numpy.array(self.alpha, dtype=numpy.float64)
+        beta = self.beta
+        beta_sum = self.beta_sum
+        num_topics = self.num_topics
+        num_words = self.num_words
+        n_t = self.n_t
+        n_t_w = self.n_t_w
+        n_t_values = self.n_t_values
+        n_t_w_values = self.n_t_w_values
+        n_d_t_phrases_values = self.n_d_t_phrases_values
+        n_d_t_words_values = self.n_d_t_words_values
+        phrase_topics = self.phrase_topics
+        last_topic = num_topics - 1
+        tokens = self.corpus.tokens
+        phrase_offsets = self.corpus.phrase_offsets
+        document_offsets = self.corpus.document_offsets
+        uniform = random.uniform
+        for document_index in range(self.document_start, self.document_end):
+            n_d_t_phrases = self.n_d_t_phrases[document_index]
+            document_row = document_index * num_topics
+            for phrase_index in range(document_offsets[document_index], document_offsets[document_index + 1]):
+                document_phrase_topic = phrase_topics[phrase_index]
+                start = phrase_offsets[phrase_index]
+                end = phrase_offsets[phrase_index + 1]
+                phrase_length = end - start
+                phrase = tokens[start:end]
+
+                # reduce counts for sampling
+                n_t_values[document_phrase_topic] -= phrase_length
+                n_d_t_phrases_values[document_row + document_phrase_topic] -= 1
+                n_d_t_words_values[document_row + document_phrase_topic] -= phrase_length
+                row = document_phrase_topic * num_words
+                for word_index in phrase:
+                    n_t_w_values[row + word_index] -= 1
+
+                if phrase_length == 1:
+                    sampling_probabilities = ((alpha + n_d_t_phrases) * (beta + n_t_w[:, phrase[0]])
+                                              / (beta_sum + n_t))
+                else:
+                    sampling_probabilities = ((alpha + n_d_t_phrases)
+                                              * (beta + n_t_w[:, list(phrase)]).prod(axis=1)
+                                              / (beta_sum + n_t) ** phrase_length)
+                cumulative_probabilities = sampling_probabilities.cumsum()
+                threshold = uniform(0.0,1.0) * cumulative_probabilities[-1]
+                document_phrase_topic = min(int(cumulative_probabilities.searchsorted(threshold, "right")), last_topic)
+
+                phrase_topics[phrase_index] = document_phrase_topic
+
+                n_t_values[document_phrase_topic] += phrase_length
+                n_d_t_phrases_values[document_row + document_phrase_topic] += 1
+                n_d_t_words_values[document_row + document_phrase_topic] += phrase_length
+                row = document_phrase_topic * num_words
+                for word_index in phrase:
+                    n_t_w_values[row + word_index] += 1
+
+    def _sweep_sparse(self):
+        """
+        Same as _sweep, sampling every phrase with _sample_topic_sparse.
+        """
+        # smoothing_sums[length] caches the sum over topics of alpha / (beta_sum + n_t) ** length
+        smoothing_sums = {}
+        for phrase_length in self.phrase_lengths:
+            smoothing_sums[phrase_length] = sum(
+                self.alpha[topic_index] / (self.beta_sum + self.n_t[topic_index]) ** phrase_length
+                for topic_index in range(self.num_topics))
+
+        for document_index in range(self.document_start, self.document_end):
+            n_d_t_phrases = self.n_d_t_phrases[document_index]
+            n_d_t_words = self.n_d_t_words[document_index]
+            document_topics = set(topic_index for topic_index in range(self.num_topics)
+                                  if n_d_t_phrases[topic_index] > 0)
+            for phrase_index in self.corpus.phrases_of(document_index):
+                document_phrase_topic = self.phrase_topics[phrase_index]
+                phrase = self.corpus.phrase(phrase_index)
+
+                # reduce counts for sampling
+                self._update_topic_size(smoothing_sums, document_phrase_topic, -len(phrase))
+                n_d_t_phrases[document_phrase_topic] -= 1
+                if n_d_t_phrases[document_phrase_topic] == 0:
+                    document_topics.discard(document_phrase_topic)
+                n_d_t_words[document_phrase_topic] -= len(phrase)
+                for word_index in phrase:
+                    self.n_t_w[document_phrase_topic][word_index] -= 1
+                    if self.n_t_w[document_phrase_topic][word_index] == 0:
+                        self.word_topics[word_index].discard(document_phrase_topic)
+
+                document_phrase_topic = self._sample_topic_sparse(
+                    phrase, n_d_t_phrases, document_topics, smoothing_sums)
+
+                self.phrase_topics[phrase_index] = document_phrase_topic
+
+                self._update_topic_size(smoothing_sums, document_phrase_topic, len(phrase))
+                n_d_t_phrases[document_phrase_topic] += 1
+                document_topics.add(document_phrase_topic)
+                n_d_t_words[document_phrase_topic] += len(phrase)
+                for word_index in phrase:
+                    self.n_t_w[document_phrase_topic][word_index] += 1
+                    self.word_topics[word_index].add(document_phrase_topic)
+
+    def _update_topic_size(self, smoothing_sums, topic_index, delta):
+        """
+        Adds delta words to the topic and keeps the cached smoothing sums up to date.
+        """
+        old_denominator = self.beta_sum + self.n_t[topic_index]
+        self.n_t[topic_index] += delta
+        new_denominator = old_denominator + delta
+        topic_alpha = self.alpha[topic_index]
+        for phrase_length in smoothing_sums:
+            smoothing_sums[phrase_length] += topic_alpha * (
+                1.0 / new_denominator ** phrase_length - 1.0 / old_denominator ** phrase_length)
+
+    def _sample_topic_sparse(self, phrase, n_d_t_phrases, document_topics, smoothing_sums):
+        """
+        Samples the topic of a phrase whose counts have been removed. With
+        L = len(phrase) and D_t = beta_sum + n_t, the weight of topic t is split into
+
+            alpha_t * beta^L / D_t^L                               (smoothing)
+            n_d_t * beta^L / D_t^L                                 (document-topic)
+            (alpha_t + n_d_t) * (prod(beta + n_t_w) - beta^L) / D_t^L  (topic-word)
+
+        The document-topic bucket is only non-zero for the topics of the document and
+        the topic-word bucket for the topics of the words in the phrase. All the words
+        of the phrase share the sampled topic.
+        """
+        phrase_length = len(phrase)
+        beta = self.beta
+        beta_power = beta ** phrase_length
+
+        word_topics = set()
+        for word_index in phrase:
+            word_topics.update(self.word_topics[word_index])
+
+        topic_word_topics = []
+        topic_word_weights = []
+        topic_word_sum = 0.0
+        # set order depends on the history of the set, which a checkpoint does not keep,
+        # so the topics are walked in order to resume exactly
+        for topic_index in sorted(word_topics):
+            product = 1.0
+            for word_index in phrase:
+                product *= beta + self.n_t_w[topic_index][word_index]
+            weight = ((self.alpha[topic_index] + n_d_t_phrases[topic_index]) * (product - beta_power)
+                      / (self.beta_sum + self.n_t[topic_index]) ** phrase_length)
+            topic_word_topics.append(topic_index)
+            topic_word_weights.append(weight)
+            topic_word_sum += weight
+
+        document_topic_topics = []
+        document_topic_weights = []
+        document_topic_sum = 0.0
+        for topic_index in document_topics:
+            weight = (n_d_t_phrases[topic_index] * beta_power
+                      / (self.beta_sum + self.n_t[topic_index]) ** phrase_length)
+            document_topic_topics.append(topic_index)
+            document_topic_weights.append(weight)
+            document_topic_sum += weight
+
+        smoothing_sum = beta_power * smoothing_sums[phrase_length]
+
+        threshold = random.uniform(0.0,1.0) * (topic_word_sum + document_topic_sum + smoothing_sum)
+        if threshold < topic_word_sum:
+            topics, weights = topic_word_topics, topic_word_weights
+        elif threshold < topic_word_sum + document_topic_sum:
+            threshold -= topic_word_sum
+            topics, weights = document_topic_topics, document_topic_weights
+        else:
+            threshold -= topic_word_sum + document_topic_sum
+            topics = range(self.num_topics)
+            weights = [beta_power * self.alpha[topic_index]
+                       / (self.beta_sum + self.n_t[topic_index]) ** phrase_length
+                       for topic_index in topics]
+
+        cumulative_sum = 0
+        for topic_index, weight in zip(topics, weights):
+            cumulative_sum += weight
+            if cumulative_sum > threshold:
+                break
+        return topic_index
+
+    def log_likelihood(self):
+        """
+        Returns the collapsed log-likelihood log p(w, z) of the current topic
+        assignments, the words of a phrase sharing its topic:
+
+            sum_d [lgamma(alpha_sum) - lgamma(alpha_sum + N_d)
+                   + sum_t (lgamma(alpha_t + n_d_t) - lgamma(alpha_t))]
+          + sum_t [lgamma(beta_sum) - lgamma(beta_sum + n_t)
+                   + sum_w (lgamma(beta + n_t_w) - lgamma(beta))]
+
+        where N_d and n_d_t count phrases, as in the sampler. Only the non-zero
+        counts contribute, and equal counts are summed once through a histogram.
+        """
+        return self._document_log_likelihood() + self._topic_log_likelihood()
+
+    def _document_log_likelihood(self):
+        """
+        Document part of the log-likelihood, over the documents of this instance.
+        """
+        lgamma = math.lgamma
+        document_offsets = self.corpus.document_offsets
+        log_likelihood = 0.0
+        for document_index in range(self.document_start, self.document_end):
+            phrases_count = document_offsets[document_index + 1] - document_offsets[document_index]
+            log_likelihood += lgamma(self.alpha_sum) - lgamma(self.alpha_sum + phrases_count)
+        for topic_index in range(self.num_topics):
+            if self.sampler == "numpy":
+                counts = self.n_d_t_phrases[self.document_start:self.document_end, topic_index]
+                count_histogram = enumerate(numpy.bincount(counts).tolist())
+            else:
+                count_histogram = Counter(self.n_d_t_phrases[document_index][topic_index]
+                                          for document_index in range(self.document_start, self.document_end))
+                count_histogram = count_histogram.iteritems()
+            topic_alpha = self.alpha[topic_index]
+            alpha_lgamma = lgamma(topic_alpha)
+            for count, documents_count in count_histogram:
+                if count > 0 and documents_count > 0:
+                    log_likelihood += documents_count * (lgamma(topic_alpha + count) - alpha_lgamma)
+        return log_likelihood
+
+    def _topic_log_likelihood(self):
+        """
+        Topic part of the log-likelihood.
+        """
+        lgamma = math.lgamma
+        log_likelihood = 0.0
+        for topic_index in range(self.num_topics):
+            log_likelihood += lgamma(self.beta_sum) - lgamma(self.beta_sum + self.n_t[topic_index])
+        if self.sampler == "numpy":
+            count_histogram = enumerate(numpy.bincount(self.n_t_w.ravel()).tolist())
+        else:
+            count_histogram = Counter()
+            for topic_index in range(self.num_topics):
+                count_histogram.update(self.n_t_w[topic_index])
+            count_histogram = count_histogram.iteritems()
+        beta_lgamma = lgamma(self.beta)
+        for count, words_count in count_histogram:
+            if count > 0 and words_count > 0:
+                log_likelihood += words_count * (lgamma(self.beta + count) - beta_lgamma)
+        return log_likelihood
 
     def _optimize_hyperparameters(self):
         self._init_topic_document_histogram()
-        for topic_index in range(self.num_topics):
-            for document_index in range(len(self.documents)):
-                self.topic_document_histogram[topic_index][self.n_d_t_words[document_index][topic_index]] += 1
+        if self.sampler == "numpy":
+            for topic_index in range(self.num_topics):
+                self.topic_document_histogram[topic_index] = numpy.bincount(
+                    self.n_d_t_words[:, topic_index], minlength=self.max_documents_words_count + 1)
+        else:
+            for n_d_t_words in self.n_d_t_words:
+                for topic_index, count in enumerate(n_d_t_words):
+                    self.topic_document_histogram[topic_index][count] += 1
 
         self.alpha_sum = dirichlet.learn_parameters(
             self.alpha, self.topic_document_histogram, self.document_length_histogram)
@@ -199,7 +887,7 @@ class PhraseLDA(object):
 
         for topic_index in range (self.num_topics):
             if self.n_t[topic_index] > max_topic_size:
-                max_topic_size = self.n_t[topic_index]
+                max_topic_size = int(self.n_t[topic_index])
 
         topic_size_histogram = [0] * (max_topic_size + 1)
         count_histogram = [0] * (max_topic_size + 1)
@@ -207,44 +895,155 @@ class PhraseLDA(object):
         topic_index = 0
         for topic_index in range(self.num_topics):
             topic_size_histogram[self.n_t[topic_index]] += 1
-            for word_index in range(self.num_words):
-                count_histogram[
-                    self.n_t_w[topic_index][word_index]] += 1
+        if self.sampler == "numpy":
+            count_histogram = numpy.bincount(self.n_t_w.ravel(), minlength=max_topic_size + 1)
+        else:
+            for topic_index in range(self.num_topics):
+                for count in self.n_t_w[topic_index]:
+                    count_histogram[count] += 1
 
         self.beta_sum = dirichlet.learn_symmetric_concentration(
             count_histogram, topic_size_histogram, self.num_words, self.beta_sum)
         self.beta = self.beta_sum / self.num_words
 
+    def save_model(self, path):
+        """
+        Stores the trained model: the topic/word and topic counts, the hyperparameters
+        and the vocabulary. The model can be loaded with load_model to label new
+        documents with infer.
+        """
+        model = {
+            'num_topics': self.num_topics,
+            'index_vocab': self.index_vocab,
+            'alpha': list(self.alpha),
+            'beta': self.beta,
+            'n_t': [int(count) for count in self.n_t],
+            'n_t_w': [array('i', (int(count) for count in row)) for row in self.n_t_w],
+        }
+        f = open(path, 'wb')
+        cPickle.dump(model, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    @classmethod
+    def load_model(cls, path):
+        """
+        Returns a PhraseLDA holding the model stored by save_model, ready for infer.
+        """
+        f = open(path, 'rb')
+        model = cPickle.load(f)
+        f.close()
+
+        plda = cls([], model['index_vocab'], model['num_topics'], beta=model['beta'])
+        plda.alpha = model['alpha']
+        plda.alpha_sum = sum(plda.alpha)
+        plda.n_t = model['n_t']
+        plda.n_t_w = model['n_t_w']
+        return plda
+
+    def infer(self, partitioned_docs, iterations=50):
+        """
+        Samples topics for the phrases of new documents against the frozen topic/word
+        counts of the trained model; only the document/topic counts of the new
+        documents change. Word ids must come from the vocabulary of the model, ids
+        it has never seen only get the smoothing mass.
+
+        Returns the topic of each phrase of each document and the topic distribution
+        of each document.
+        """
+        # word_factors[word][topic] = (beta + n_t_w) / (beta_sum + n_t), fixed for the model
+        word_factors = {}
+
+        def factors(word_index):
+            if word_index not in word_factors:
+                if word_index < self.num_words:
+                    word_factors[word_index] = [
+                        (self.beta + self.n_t_w[topic_index][word_index]) / (self.beta_sum + self.n_t[topic_index])
+                        for topic_index in range(self.num_topics)]
+                else:
+                    word_factors[word_index] = [
+                        self.beta / (self.beta_sum + self.n_t[topic_index])
+                        for topic_index in range(self.num_topics)]
+            return word_factors[word_index]
+
+        documents_phrases_topic = []
+        documents_topic_distribution = []
+        for document in partitioned_docs:
+            phrases_factors = []
+            for phrase in document:
+                phrase_factors = [1.0] * self.num_topics
+                for word_index in phrase:
+                    word_factor = factors(word_index)
+                    for topic_index in range(self.num_topics):
+                        phrase_factors[topic_index] *= word_factor[topic_index]
+                phrases_factors.append(phrase_factors)
+
+            n_d_t = [0] * self.num_topics
+            document_phrases_topic = []
+            for phrase_factors in phrases_factors:
+                document_phrase_topic = random.randint(0,self.num_topics-1)
+                document_phrases_topic.append(document_phrase_topic)
+                n_d_t[document_phrase_topic] += 1
+
+            for iteration in range(iterations):
+                for phrase_index, phrase_factors in enumerate(phrases_factors):
+                    n_d_t[document_phrases_topic[phrase_index]] -= 1
+                    sampling_probabilities = [(self.alpha[topic_index] + n_d_t[topic_index]) * phrase_factors[topic_index]
+                                              for topic_index in range(self.num_topics)]
+                    document_phrase_topic = self._sample_topic(sampling_probabilities)
+                    document_phrases_topic[phrase_index] = document_phrase_topic
+                    n_d_t[document_phrase_topic] += 1
+
+            normalizer = len(phrases_factors) + self.alpha_sum
+            documents_phrases_topic.append(document_phrases_topic)
+            documents_topic_distribution.append(
+                [(n_d_t[topic_index] + self.alpha[topic_index]) / normalizer for topic_index in range(self.num_topics)])
+
+        return documents_phrases_topic, documents_topic_distribution
+
     def store_phrase_topics(self, path):
         f = open(path, 'w')
-        for document in self.documents_phrases_topic:
-            f.write(",".join(str(phrase) for phrase in document))
+        for document_index in range(self.num_documents):
+            phrases = self.corpus.phrases_of(document_index)
+            f.write(",".join(str(self.phrase_topics[phrase_index]) for phrase_index in phrases))
             f.write("\n")
 
     def _getTopics(self):
         """
-        Returns the set of phrases modelling each document.
+        Returns the number of occurrences of every phrase of more than one word in
+        each topic, keyed by phrase id, and the phrases as tuples of word ids indexed
+        by their id. Phrase ids follow the order of first appearance in the corpus.
         """
-        topics = []
-        for i in range(self.num_topics):
-            topics.append(Counter())
-        for document_index, document in enumerate(self.documents_phrases_topic):
-            for phrase_index, phrase_topic in enumerate(document):
-                phrase = " ".join(str(word) for word in self.documents[document_index][phrase_index])
-                topics[phrase_topic][phrase] += 1
-        return topics
+        topics = [Counter() for __ in range(self.num_topics)]
+        phrase_ids = {}
+        phrases = []
+        tokens = self.corpus.tokens
+        phrase_offsets = self.corpus.phrase_offsets
+        for phrase_index, phrase_topic in enumerate(self.phrase_topics):
+            start = phrase_offsets[phrase_index]
+            end = phrase_offsets[phrase_index + 1]
+            if end - start < 2:
+                continue
+            phrase = tuple(tokens[start:end])
+            phrase_id = phrase_ids.get(phrase)
+            if phrase_id is None:
+                phrase_id = phrase_ids[phrase] = len(phrases)
+                phrases.append(phrase)
+            topics[phrase_topic][phrase_id] += 1
+        return topics, phrases
 
-    def _getMostFrequentPhrasalTopics(self, topics):
+    def _getMostFrequentPhrasalTopics(self, topics, phrases):
+        """
+        Returns the top_phrases most frequent phrases of each topic, as strings along
+        with their count, in descending order of count and then of first appearance.
+        Only the returned phrases are turned into strings.
+        """
+        rank = lambda (phrase_id, count): (-count, phrase_id)
         output = []
-        topic_index = 0
         for topic in topics:
-            output_for_topic = []
-            print "topic", topic_index
-            for phrase, count in topic.most_common():
-                if len(phrase.split(" ")) > 1:
-                    val = utils._get_string_phrase(phrase, self.index_vocab), count
-                    output_for_topic.append(val)
-                    print val
-            output.append(output_for_topic)
-            topic_index += 1
+            if self.top_phrases is None:
+                most_frequent = sorted(topic.iteritems(), key=rank)
+            else:
+                most_frequent = heapq.nsmallest(self.top_phrases, topic.iteritems(), key=rank)
+            output.append([(" ".join(self.index_vocab[word] for word in phrases[phrase_id]), count)
+                           for phrase_id, count in most_frequent])
         return output
@@ -4,6 +4,199 @@ from collections import Counter
 import math
 import heapq
 import sys
+import multiprocessing
+import cPickle
+import os
+from array import array
+from bisect import bisect_right
+from operator import itemgetter
+from instrumentation import NULL_INSTRUMENTATION
+from corpus import SentenceCorpus
+
+STOPWORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stopwords.txt")
+
+# values of the token lookup of the tokenizer that are not word ids
+_STOPWORD = -1
+_SENTENCE_END = -2
+
+# state shared with the worker processes of a pool. It is installed by the pool
+# initializer, which on fork-based platforms means the workers simply inherit it.
+_worker_state = {}
+
+def _init_worker(state):
+    _worker_state.clear()
+    _worker_state.update(state)
+
+def _cluster_documents_chunk(bounds):
+    """
+    Runs agglomerative clustering on documents[start:end] of the shared worker state.
+    """
+    start, end = bounds
+    miner = _worker_state['miner']
+    documents = _worker_state['documents']
+    significance_cache = _worker_state['significance_cache']
+    alpha = _worker_state['alpha']
+    return [miner._agglomerative_clustering(documents[i], significance_cache, alpha)
+            for i in range(start, end)]
+
+def _preprocess_chunk(bounds):
+    """
+    Tokenizes the lines of the byte range [start, end) of the shared input file, with
+    a vocabulary of its own, and counts its words. The flat arrays of the sentences
+    are sent back as strings, which are much cheaper to pickle.
+    """
+    start, end = bounds
+    miner = _worker_state['miner']
+    f = open(_worker_state['file_name'], 'rb')
+    f.seek(start)
+    lines = f.read(end - start).split('\n')
+    f.close()
+    #the range ends with a newline, except maybe the last one of the file
+    if lines[-1] == '':
+        lines.pop()
+
+    vocab = {}
+    index_vocab = []
+    lookup = miner._token_lookup(_worker_state['stopwords'], vocab)
+    documents, document_range = miner._encode_lines(lines, lookup, vocab, index_vocab)
+    counts = [0] * len(index_vocab)
+    for word_id in documents.tokens:
+        counts[word_id] += 1
+    return (documents.tokens.tostring(), documents.sentence_offsets.tostring(),
+            array('i', document_range).tostring(), index_vocab, counts)
+
+def _mine_shard(connection, miner, documents, active_indices, min_support):
+    """
+    Worker loop of the sharded frequent pattern mining. Receives the length of the
+    phrases to count along with the frequent phrases of the previous level, and replies
+    with the partial counts of its shard and the number of positions it still has.
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        n, frequent_counts = message
+        counter = Counter()
+        active_indices = miner._count_phrase_candidates(
+            documents, active_indices, n, frequent_counts, min_support, counter)
+        connection.send((counter, len(active_indices)))
+    connection.close()
+
+def _significance(actual_occurence, count1, count2, total_words):
+    """
+    Significance score of a phrase seen actual_occurence times, made of two phrases
+    seen count1 and count2 times.
+    """
+    if actual_occurence == 0:
+        return float("-inf")
+
+    numerator = count1*count2
+    denominator = total_words * total_words
+    independent_prob = numerator/denominator
+    independent_prob *= 2
+
+    expected_occurence = independent_prob*total_words
+
+    return (actual_occurence-expected_occurence)/math.sqrt(max(actual_occurence, expected_occurence))
+
+def _chunk_bounds(size, num_chunks):
+    """
+    Splits range(size) into at most num_chunks contiguous (start, end) pairs.
+    """
+    chunk_size = max(1, -(-size // max(1, num_chunks)))
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+def _line_bounds(file_name, num_chunks):
+    """
+    Splits the file into at most num_chunks contiguous (start, end) byte ranges that
+    each start at the beginning of a line.
+    """
+    size = os.path.getsize(file_name)
+    offsets = [0]
+    f = open(file_name, 'rb')
+    for start, __ in _chunk_bounds(size, num_chunks)[1:]:
+        if start <= offsets[-1]:
+            continue
+        #move to the end of the line holding the byte before start
+        f.seek(start - 1)
+        f.readline()
+        offset = f.tell()
+        if offsets[-1] < offset < size:
+            offsets.append(offset)
+    f.close()
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+class SignificanceCache(object):
+    """
+    Significance scores of pairs of adjacent phrases, shared by all the sentences of
+    a corpus. Every phrase of the final phrase counts gets an integer id once, so a
+    pair is keyed by a single integer built from the ids of its two phrases. Worker
+    processes inherit the ids and counts when they are forked.
+    The scores are kept in two generations of at most capacity / 2 pairs each: a
+    pair is moved to the current generation when it is used, and the oldest
+    generation is dropped when the current one is full. This approximates LRU
+    eviction, so pairs that are seen rarely are the ones dropped.
+    :param hash_counter:
+        map from phrases to their respective raw frequency.
+    :param total_words:
+        total count of the words in the input corpus.
+    :param capacity:
+        maximum number of pairs kept.
+    """
+
+    def __init__(self, hash_counter, total_words, capacity=1000000):
+        self.phrase_ids = {}
+        self.counts = []
+        for phrase, count in hash_counter.iteritems():
+            self.phrase_ids[phrase] = len(self.counts)
+            self.counts.append(count)
+        self.total_words = total_words
+        self.capacity = capacity
+        self.recent = {}
+        self.previous = {}
+
+    def phrase_id(self, phrase):
+        """
+        Returns the id of the phrase. Phrases missing from the counts, like words
+        below the support threshold, get a new id with a count of zero.
+        """
+        phrase_id = self.phrase_ids.get(phrase)
+        if phrase_id is None:
+            phrase_id = len(self.counts)
+            self.phrase_ids[phrase] = phrase_id
+            self.counts.append(0)
+        return phrase_id
+
+    def get(self, key):
+        """
+        Returns the (score, combined phrase id) pair cached for key, or None.
+        """
+        entry = self.recent.get(key)
+        if entry is None:
+            entry = self.previous.get(key)
+            if entry is not None:
+                self._store(key, entry)
+        return entry
+
+    def add(self, key, phrase_id1, phrase_id2, combined_phrase):
+        """
+        Computes, caches and returns the (score, combined phrase id) pair of the two
+        phrases. The combined id is None when the combined phrase is not frequent.
+        """
+        combined_id = self.phrase_ids.get(combined_phrase)
+        actual_occurence = 0 if combined_id is None else self.counts[combined_id]
+        score = _significance(actual_occurence, self.counts[phrase_id1], self.counts[phrase_id2],
+                              self.total_words)
+        entry = (score, combined_id)
+        self._store(key, entry)
+        return entry
+
+    def _store(self, key, entry):
+        self.recent[key] = entry
+        if len(self.recent) >= self.capacity // 2:
+            self.previous = self.recent
+            self.recent = {}
 
 class PhraseMining(object):
     """
@@ -18,13 +211,56 @@ class PhraseMining(object):
         maximum allowed phrase size.
     :param alpha:
         threshold for the significance score.
+    :param use_token_ids:
+        map every token to an integer id once and count phrases as tuples of
+        ids instead of space-joined strings. Phrases are converted back to
+        strings only when they are reported.
+    :param workers:
+        number of processes used to tokenize chunks of the input file, to count the
+        frequent patterns level by level and to segment the sentences once the phrase
+        counts are known. The output is identical to the single process run.
+    :param significance_cache_size:
+        maximum number of phrase pairs whose significance score is cached while
+        segmenting the sentences.
+    :param sentence_delimiters:
+        characters ending a sentence. Phrases never span two sentences. An empty
+        string keeps every line as a single sentence.
+    :param stopwords_file:
+        file listing one stopword per line, stopwords.txt next to this module by
+        default.
+    :param keep_raw_counts:
+        keeps the raw count of every candidate phrase, frequent or not, along with
+        the encoded sentences and their segmentation, which update and save_state
+        need. When False the infrequent candidates are dropped as soon as their
+        level is counted, and the sentences once they are partitioned, which
+        reclaims their memory.
+    :param instrumentation:
+        an instrumentation.Instrumentation receiving the time of every stage, the
+        number of candidate phrases of every mining level and the number of merges
+        of the clustering. Nothing is measured when it is None.
     """
 
-    def __init__(self, file_name, min_support=10, max_phrase_size=40, alpha=4):
+    def __init__(self, file_name, min_support=10, max_phrase_size=40, alpha=4, use_token_ids=True,
+                 workers=1, significance_cache_size=1000000, sentence_delimiters=".,;!?",
+                 stopwords_file=STOPWORDS_FILE, keep_raw_counts=True, instrumentation=None):
         self.min_support = min_support
         self.max_phrase_size = max_phrase_size
         self.alpha = alpha
         self.file_name = file_name
+        self.use_token_ids = use_token_ids
+        self.workers = workers
+        self.significance_cache_size = significance_cache_size
+        self.sentence_delimiters = sentence_delimiters
+        self.stopwords_file = stopwords_file
+        self.keep_raw_counts = keep_raw_counts
+        #a token is a run of letters and digits, or a single sentence delimiter
+        if sentence_delimiters:
+            self.token_pattern = re.compile("[a-z0-9]+|[{0}]".format(re.escape(sentence_delimiters)))
+        else:
+            self.token_pattern = re.compile("[a-z0-9]+")
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        #word id -> sentences holding it, built by update when first needed
+        self.sentence_index = None
 
     def mine(self):
         return self._run_phrase_mining(self.min_support, self.max_phrase_size, self.alpha, self.file_name)
@@ -32,7 +268,8 @@ class PhraseMining(object):
     def _frequentPatternMining(self, documents, min_support, max_phrase_size, word_freq, active_indices):
         """
         Performs frequent pattern mining to collect aggregate counts for all contiguous phrases in the 
-        input document that satisfy a certain minimum support threshold.
+        input document that satisfy a certain minimum support threshold. Returns the raw counts,
+        which _rectify prunes by the minimum support.
 
         Parameters:
         @documents: the input corpus
@@ -46,6 +283,8 @@ class PhraseMining(object):
         
         #iterate until documents is empty
         while(len(documents) > 0):
+            #phrases of length n are counted apart and only the frequent ones are kept
+            level_counter = Counter()
             temp_documents = []
             new_active_indices = []
             #go over each document
@@ -81,109 +320,444 @@ class PhraseMining(object):
                                     phrase += words[idx]
                                 else:
                                     phrase += words[idx] + " "
-                        hash_counter[phrase] += 1
+                        level_counter[phrase] += 1
 
             documents = temp_documents
             active_indices = new_active_indices
+            self.instrumentation.count("frequent_patterns.candidates.length_{0}".format(n),
+                                       len(level_counter))
+            self._merge_level(hash_counter, level_counter, min_support, True)
             n += 1
             if n == max_phrase_size:
                 break
         
-        hash_counter = Counter(x for x in hash_counter.elements() if hash_counter[x] >= min_support)
-        
         return hash_counter 
 
-    def _agglomerative_clustering(self, doc, hash_counter, alpha, total_words):
+    def _frequentPatternMiningIds(self, documents, min_support, max_phrase_size, word_freq, active_indices):
+        """
+        Same as _frequentPatternMining, but over a SentenceCorpus of token ids.
+        Phrases are keyed by tuples of ids, so a candidate key is a single slice
+        of the corpus instead of a concatenated string. The active indices are the
+        positions in the corpus of the phrases still counted, in one flat array.
+        word_freq is updated in place and returned.
+
+        Parameters:
+        @documents: the input corpus, as a SentenceCorpus
+        @min_support: minimum support threshold which must be satisfied by each phrase.
+        @max_phrase_size: maximum allowed phrase size
+        @word_freq: raw frequency of each word, keyed by 1-tuples of token ids
+        @active_indices: array of active positions
+        """
+        hash_counter = word_freq
+        n = 2
+
+        #iterate until no position is active
+        while(len(active_indices) > 0):
+            level_counter = Counter()
+            active_indices = self._count_phrase_candidates(
+                documents, active_indices, n, hash_counter, min_support, level_counter)
+            self.instrumentation.count("frequent_patterns.candidates.length_{0}".format(n),
+                                       len(level_counter))
+            self._merge_level(hash_counter, level_counter, min_support, not self.keep_raw_counts)
+            n += 1
+            if n == max_phrase_size:
+                break
+
+        return hash_counter
+
+    def _merge_level(self, hash_counter, level_counter, min_support, prune):
+        """
+        Adds the counts of one level of candidate phrases to hash_counter. When prune
+        is set only the phrases meeting the minimum support are added, the others are
+        freed along with level_counter.
+        """
+        if prune:
+            for key, count in level_counter.iteritems():
+                if count >= min_support:
+                    hash_counter[key] += count
+        else:
+            hash_counter.update(level_counter)
+
+    def _count_phrase_candidates(self, documents, active_indices, n, frequent_counts, min_support, counter):
+        """
+        Runs one level of the id-based frequent pattern mining: keeps the positions whose
+        phrase of length n-1 meets the minimum support and counts the phrases of length n
+        starting at two consecutive such positions of the same sentence. Returns the
+        positions kept.
+
+        Parameters:
+        @documents: the input corpus, as a SentenceCorpus
+        @active_indices: array of active positions, in increasing order
+        @n: length of the phrases counted at this level
+        @frequent_counts: raw frequency of the phrases of length n-1
+        @min_support: minimum support threshold which must be satisfied by each phrase.
+        @counter: counter updated with the phrases of length n
+        """
+        tokens = documents.tokens
+        sentence_offsets = documents.sentence_offsets
+        new_active_indices = array('i')
+        append = new_active_indices.append
+        #bounds of the sentence holding the current position
+        start = end = 0
+        previous = -2
+        for index in active_indices:
+            if index >= end:
+                sentence_index = bisect_right(sentence_offsets, index)
+                start = sentence_offsets[sentence_index - 1]
+                end = sentence_offsets[sentence_index]
+            #get set of positions of phrases of length n-1 with min support
+            if index <= end - n + 1 and frequent_counts[tuple(tokens[index:index+n-1])] >= min_support:
+                if index == previous + 1 and index != start:
+                    counter[tuple(tokens[previous:previous+n])] += 1
+                append(index)
+                previous = index
+
+        return new_active_indices
+
+    def _update_frequent_patterns(self, documents, active_indices, word_freq):
+        """
+        Adds the counts of the new documents to raw_counter, so that it holds the raw
+        counts mining the whole corpus would give. Level by level, the candidates of
+        the new documents are counted, along with the candidates of the old sentences
+        that only become candidates because a shorter phrase reaches the minimum
+        support with the update. Two consecutive positions of an old sentence make
+        such a candidate only if the phrase at one of them is newly frequent, so only
+        the occurrences of the newly frequent phrases are visited. Returns the keys
+        whose raw count changed.
+
+        Parameters:
+        @documents: the new documents, as a SentenceCorpus
+        @active_indices: array of active positions of the new documents
+        @word_freq: raw frequency of each word of the new documents
+        """
+        raw_counter = self.raw_counter
+        min_support = self.min_support
+        tokens = self.documents.tokens
+        sentence_offsets = self.documents.sentence_offsets
+        changed_keys = set(word_freq)
+        newly_frequent = set(key for key, count in word_freq.iteritems()
+                             if raw_counter[key] < min_support <= raw_counter[key] + count)
+        raw_counter.update(word_freq)
+
+        n = 2
+        while len(active_indices) > 0 or len(newly_frequent) > 0:
+            level_counter = Counter()
+            active_indices = self._count_phrase_candidates(
+                documents, active_indices, n, raw_counter, min_support, level_counter)
+
+            #old candidates have a newly frequent phrase at their first or second position
+            positions = self._phrase_positions(newly_frequent) if newly_frequent else ()
+            starts = set()
+            for position in positions:
+                sentence_index = bisect_right(sentence_offsets, position)
+                start = sentence_offsets[sentence_index - 1]
+                end = sentence_offsets[sentence_index]
+                for index in (position - 1, position):
+                    if (index >= start and index + n <= end
+                            and raw_counter[tuple(tokens[index:index+n-1])] >= min_support
+                            and raw_counter[tuple(tokens[index+1:index+n])] >= min_support):
+                        starts.add(index)
+            for index in starts:
+                level_counter[tuple(tokens[index:index+n])] += 1
+            self.instrumentation.count("frequent_patterns.recounted_positions", len(positions))
+            self.instrumentation.count("frequent_patterns.candidates.length_{0}".format(n),
+                                       len(level_counter))
+
+            changed_keys.update(level_counter)
+            newly_frequent = set(key for key, count in level_counter.iteritems()
+                                 if raw_counter[key] < min_support <= raw_counter[key] + count)
+            raw_counter.update(level_counter)
+            n += 1
+            if n == self.max_phrase_size:
+                break
+
+        return changed_keys
+
+    def _phrase_positions(self, keys):
+        """
+        Returns, in increasing order, the positions in the mined sentences where one
+        of the phrases of keys starts. Only the sentences holding the rarest word of
+        each phrase are searched, as given by the inverted index of the sentences.
+        """
+        tokens = self.documents.tokens
+        sentence_offsets = self.documents.sentence_offsets
+        sentence_index = self._get_sentence_index()
+        no_sentences = array('i')
+        candidates = set()
+        for key in keys:
+            candidates.update(min((sentence_index.get(word, no_sentences) for word in key), key=len))
+
+        lengths = sorted(set(len(key) for key in keys))
+        positions = array('i')
+        for candidate in sorted(candidates):
+            end = sentence_offsets[candidate + 1]
+            for position in xrange(sentence_offsets[candidate], end):
+                for length in lengths:
+                    if position + length > end:
+                        break
+                    if tuple(tokens[position:position+length]) in keys:
+                        positions.append(position)
+                        break
+        return positions
+
+    def _get_sentence_index(self):
+        """
+        Returns the inverted index of the mined sentences, which maps every word id to
+        the array of the sentences holding it. It is built the first time it is needed.
+        """
+        if self.sentence_index is None:
+            self.sentence_index = {}
+            self._index_sentences(0)
+        return self.sentence_index
+
+    def _index_sentences(self, start):
+        """
+        Adds the sentences from start on to the inverted index.
+        """
+        sentence_index = self.sentence_index
+        documents = self.documents
+        for document_index in xrange(start, len(documents)):
+            for word in set(documents[document_index]):
+                sentences = sentence_index.get(word)
+                if sentences is None:
+                    sentences = sentence_index[word] = array('i')
+                sentences.append(document_index)
+
+    def _frequentPatternMiningSharded(self, documents, min_support, max_phrase_size, word_freq, active_indices):
+        """
+        Parallel version of _frequentPatternMiningIds. The active positions are split
+        by sentence into one shard per worker process, which inherits the corpus. At
+        each level every shard counts its candidate phrases (map), then the partial
+        counters are merged and pruned by the minimum support (reduce) before the next
+        level is sent out.
+
+        Parameters:
+        @documents: the input corpus, as a SentenceCorpus
+        @min_support: minimum support threshold which must be satisfied by each phrase.
+        @max_phrase_size: maximum allowed phrase size
+        @word_freq: raw frequency of each word, keyed by 1-tuples of token ids
+        @active_indices: array of active positions
+        """
+        hash_counter = word_freq
+        connections = []
+        processes = []
+        for start, end in _chunk_bounds(len(documents), self.workers):
+            shard_start = bisect_right(active_indices, documents.sentence_offsets[start] - 1)
+            shard_end = bisect_right(active_indices, documents.sentence_offsets[end] - 1)
+            connection, child_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_mine_shard, args=(
+                child_connection, self, documents, active_indices[shard_start:shard_end], min_support))
+            process.daemon = True
+            process.start()
+            child_connection.close()
+            connections.append(connection)
+            processes.append(process)
+
+        try:
+            frequent_counts = Counter(dict((key, count) for key, count in word_freq.items()
+                                           if count >= min_support))
+            n = 2
+            while(len(connections) > 0):
+                for connection in connections:
+                    connection.send((n, frequent_counts))
+
+                level_counter = Counter()
+                active_connections = []
+                for connection in connections:
+                    partial_counter, remaining_positions = connection.recv()
+                    level_counter.update(partial_counter)
+                    if remaining_positions > 0:
+                        active_connections.append(connection)
+                    else:
+                        connection.send(None)
+                connections = active_connections
+
+                self.instrumentation.count("frequent_patterns.candidates.length_{0}".format(n),
+                                           len(level_counter))
+                self._merge_level(hash_counter, level_counter, min_support, not self.keep_raw_counts)
+                frequent_counts = Counter(dict((key, count) for key, count in level_counter.iteritems()
+                                               if count >= min_support))
+                level_counter = None
+                n += 1
+                if n == max_phrase_size:
+                    break
+        finally:
+            for connection in connections:
+                connection.send(None)
+            for process in processes:
+                process.join()
+
+        return hash_counter
+
+    def _agglomerative_clustering(self, doc, significance_cache, alpha):
         """
         Performs agglomerative clustering to get meaningful phrases from the input document.
 
         Parameters:
         @doc: input corpus
-        @hash_counter: map from phrases to their respective raw frequency
+        @significance_cache: SignificanceCache built from the phrase counts of the corpus
         @alpha: threshold for the significance score
-        @total_words: total count of the words in input corpus.
-        """
-        sig_map = {}
-        phrases = doc.split()
-        while(True):
-            max_sig = float("-inf")
-            max_pair = -1
-            for index, word in enumerate(phrases[:-1]):
-                phrase = phrases[index]+" "+phrases[index+1]
-                if phrase not in sig_map:
-                    sig_score = self._significance_score(phrases[index], phrases[index+1], hash_counter, total_words)
-                    sig_map[phrase] = sig_score
-                
-                if(max_sig < sig_map[phrase]):
-                    max_sig = sig_map[phrase]
-                    max_pair = index
-
-            if(max_sig < alpha):
-                break
-                
+        """
+        string_doc = isinstance(doc, basestring)
+        if string_doc:
+            tokens = doc.split()
+        else:
+            tokens = doc
+
+        def phrase_key(start, end):
+            if string_doc:
+                return " ".join(tokens[start:end])
+            return tuple(tokens[start:end])
+
+        # the phrases form a linked list; a merge folds the right phrase into
+        # the left one, so every node keeps its original position and the
+        # leftmost of several equally significant pairs still wins. Node i
+        # holds tokens[i:next_index[i]] and the id of that phrase.
+        size = len(tokens)
+        next_index = range(1, size + 1)
+        prev_index = range(-1, size - 1)
+        versions = [0] * size
+        if string_doc:
+            phrase_ids = [significance_cache.phrase_id(word) for word in tokens]
+        else:
+            phrase_ids = [significance_cache.phrase_id((word,)) for word in tokens]
+        get_entry = significance_cache.get
+
+        def push_pair(left, right):
+            key = (phrase_ids[left] << 32) | phrase_ids[right]
+            entry = get_entry(key)
+            if entry is None:
+                entry = significance_cache.add(key, phrase_ids[left], phrase_ids[right],
+                                               phrase_key(left, next_index[right]))
+            sig_score, combined_id = entry
+            # pairs below the threshold can never be merged
+            if sig_score >= alpha:
+                heapq.heappush(heap, (-sig_score, left, versions[left], right, versions[right], combined_id))
+
+        heap = []
+        for index in range(size - 1):
+            push_pair(index, index + 1)
+
+        while heap:
+            __, left, left_version, right, right_version, combined_id = heapq.heappop(heap)
+            # skip entries made stale by an earlier merge
+            if (next_index[left] != right or versions[left] != left_version
+                    or versions[right] != right_version):
+                continue
+
             #merge max pair
-            merged_phrase = phrases[max_pair] + " "+ phrases[max_pair+1]
-            
-            #fix phrases
-            phrases[max_pair] = merged_phrase
-            phrases.pop(max_pair+1)
-        
-        return phrases
-            
-    def _significance_score(self, phrase1, phrase2, hash_counter, total_words):
+            phrase_ids[left] = combined_id
+            versions[left] += 1
+            versions[right] += 1
+            next_index[left] = next_index[right]
+            if next_index[left] < size:
+                prev_index[next_index[left]] = left
+            prev_index[right] = -1
+
+            #only the pairs touching the merged phrase change
+            if prev_index[left] >= 0:
+                push_pair(prev_index[left], left)
+            if next_index[left] < size:
+                push_pair(left, next_index[left])
+
+        merged_phrases = []
+        index = 0
+        while index < size:
+            merged_phrases.append(phrase_key(index, next_index[index]))
+            index = next_index[index]
+        return merged_phrases
+
+    def _cluster_documents(self, documents, significance_cache, alpha):
         """
-        Calculates the signifance score of the phrase obtained by joining phrase1 
-        and phrase2. The significance score basically measures how unlikely is the
-        new phrase. The more unlikely it is, the more informative it will be.
+        Runs agglomerative clustering on every sentence, splitting the sentences across
+        self.workers processes when more than one worker is requested. Chunks are
+        contiguous and collected in order, so the result lines up with document_range.
+        """
+        if self.workers <= 1 or len(documents) < 2:
+            doc_phrases = [self._agglomerative_clustering(doc, significance_cache, alpha)
+                           for doc in documents]
+            self._count_merges(documents, doc_phrases)
+            return doc_phrases
 
-        Parameters:
-        @phrase1: first phrase
-        @phrase2: second phrase
-        @hash_counter: map from phrases to their respective raw frequency
-        @total_words: total count of the words in input corpus.
-        """
-        combined_phrase = phrase1+" "+phrase2
-        combined_size = len(combined_phrase.split())
-        actual_occurence = hash_counter[combined_phrase]
-        numerator = hash_counter[phrase1]*hash_counter[phrase2]
-        
-        if actual_occurence == 0:
-            return float("-inf")
-        
-        denominator = total_words * total_words
-        independent_prob = numerator/denominator
-        independent_prob *= 2
-        
-        expected_occurence = independent_prob*total_words
-        
-        return (actual_occurence-expected_occurence)/math.sqrt(max(actual_occurence, expected_occurence))
+        state = {'miner': self, 'documents': documents, 'significance_cache': significance_cache,
+                 'alpha': alpha}
+        pool = multiprocessing.Pool(self.workers, _init_worker, (state,))
+        try:
+            chunks = pool.map(_cluster_documents_chunk, _chunk_bounds(len(documents), self.workers * 4))
+        finally:
+            pool.close()
+            pool.join()
+
+        doc_phrases = []
+        for chunk in chunks:
+            doc_phrases.extend(chunk)
+        self._count_merges(documents, doc_phrases)
+        return doc_phrases
 
-    def _get_true_frequency(self, hash_counter):
+    def _count_merges(self, documents, doc_phrases):
         """
-        Updates the raw frequency of the phrases to get their true frequencies.
+        Reports the number of segmented sentences and of merges made to segment them.
         """
-        true_counter = Counter(hash_counter)
-        for key in hash_counter:
-            val = key.split()
-            if len(val) <= 1:
-                continue
-            substr1 = " ".join(val[0:-1])
-            substr2 = " ".join(val[1:])
-            true_counter[substr1] -= hash_counter[key]
-            true_counter[substr2] -= hash_counter[key]
+        if not self.instrumentation.enabled:
+            return
+        words_count = 0
+        for doc in documents:
+            words_count += len(doc.split()) if isinstance(doc, basestring) else len(doc)
+        self.instrumentation.count("clustering.sentences", len(documents))
+        self.instrumentation.count("clustering.merges", words_count - sum(len(phrases) for phrases in doc_phrases))
 
-        return true_counter
+    def _rectify(self, raw_counter, min_support):
+        """
+        Prunes the raw counts by the minimum support and computes the true frequency of
+        the remaining phrases, in a single pass over the distinct phrases. The true
+        frequency of a phrase is its raw frequency minus the raw frequencies of the
+        phrases one word longer that extend it on either side. Returns the pruned
+        counter and the true counter.
+        """
+        hash_counter = Counter()
+        true_counter = Counter()
+        for key, count in raw_counter.iteritems():
+            if count < min_support or count <= 0:
+                continue
+            hash_counter[key] = count
+            true_counter[key] += count
+            if isinstance(key, tuple):
+                if len(key) <= 1:
+                    continue
+                true_counter[key[:-1]] -= count
+                true_counter[key[1:]] -= count
+            else:
+                space = key.find(" ")
+                if space < 0:
+                    continue
+                true_counter[key[:key.rfind(" ")]] -= count
+                true_counter[key[space + 1:]] -= count
+        return hash_counter, true_counter
 
-    def _get_stopwords(self):
+    def get_stopwords(self):
         """
-        Returns a list of stopwords.
+        Returns the set of stopwords, read from the stopwords file.
         """
-        f = open("topmine_src/stopwords.txt")
+        f = open(self.stopwords_file)
         stopwords = set()
         for line in f:
             stopwords.add(line.rstrip())
+        f.close()
         return stopwords
 
+    def _token_lookup(self, stopwords, vocab):
+        """
+        Returns the map used by the tokenizer: the id of every word of vocab,
+        _STOPWORD for the stopwords and _SENTENCE_END for the sentence delimiters, so
+        that every token is classified by a single lookup.
+        """
+        lookup = dict(vocab)
+        for word in stopwords:
+            lookup[word] = _STOPWORD
+        for delimiter in self.sentence_delimiters:
+            lookup[delimiter] = _SENTENCE_END
+        return lookup
+
     def _get_word_freq(self, documents):
         """
         Calculates the frequency of each word in the input document.
@@ -202,6 +776,18 @@ class PhraseMining(object):
 
         return total_words, word_freq, active_indices
 
+    def _get_word_freq_ids(self, documents):
+        """
+        Calculates the frequency of each word in the id-encoded input document.
+        Words are keyed by 1-tuples so that they share the key space of longer phrases.
+        Every position of the corpus is active to start with.
+        """
+        word_freq = Counter()
+        for word in documents.tokens:
+            word_freq[(word,)] += 1
+
+        return len(documents.tokens), word_freq, documents.positions()
+
     def _get_partitioned_docs(self, document_range, doc_phrases):
         """
         Partitions the input document based on the punctuations.
@@ -237,37 +823,145 @@ class PhraseMining(object):
                 document_of_phrases.append(phrases_of_words)
             self.partitioned_docs.append(document_of_phrases)
 
+    def _process_partitioned_id_docs(self, partitioned_docs, vocab, index_vocab):
+        """
+        Same as _process_partitioned_docs for documents whose phrases are already tuples
+        of token ids. Ids are assigned in order of first appearance in both cases, so the
+        resulting vocabulary is identical. The documents are converted in place, so
+        that each list of tuples is freed as soon as it is converted.
+        """
+        self.vocab = vocab
+        self.index_vocab = index_vocab
+        for document_index, document in enumerate(partitioned_docs):
+            partitioned_docs[document_index] = [list(phrase) for phrase in document]
+        self.partitioned_docs = partitioned_docs
+
     def _preprocess_input(self, filename, stopwords):
         """
         Performs preprocessing on the input document. Includes stopword removal.
+        Every line is lowercased and tokenized in a single pass by token_pattern,
+        which yields the words and the sentence delimiters in order.
         """
         f = open(filename, 'r')
         documents = []
         document_range = []
-        i = 0
         num_docs = 0
+        lookup = self._token_lookup(stopwords, {})
+        find_tokens = self.token_pattern.findall
         for line in f:
-            line_lowercase = line.lower()
-            sentences_no_punc = re.split(r"[.,;!?]",line_lowercase)
-            stripped_sentences = []
-            for sentence in sentences_no_punc:
-                stripped_sentences.append(re.sub('[^A-Za-z0-9]+', ' ', sentence))
-            sentences_no_punc = stripped_sentences
-            i += len(sentences_no_punc)
-            document_range.append(i)
-            documents.extend(sentences_no_punc)
+            words = []
+            for token in find_tokens(line.lower()):
+                kind = lookup.get(token)
+                if kind == _SENTENCE_END:
+                    documents.append(' '.join(words))
+                    words = []
+                elif kind != _STOPWORD:
+                    words.append(token)
+            documents.append(' '.join(words))
+            document_range.append(len(documents))
             num_docs += 1
+        f.close()
 
-        documents = [doc.strip() for doc in documents]
+        return documents, document_range, num_docs
 
-        # remove stop-words
-        documents2 = []
-        for doc in documents:
-            documents2.append(' '.join([word for word in doc.split() if word not in stopwords]))
+    def _preprocess_input_ids(self, filename, stopwords, vocab=None, index_vocab=None):
+        """
+        Streaming counterpart of _preprocess_input. Each line is tokenized, stripped of
+        stopwords and mapped to integer ids as it is read, and the sentences are kept
+        back to back in a SentenceCorpus, so no string copy of the corpus is ever held
+        in memory.
+        A single lookup per token gives its id, or tells it is a stopword or the end of
+        a sentence. Ids are assigned in order of first appearance, continuing the given
+        vocabulary if there is one.
+        """
+        f = open(filename, 'r')
+        if vocab is None:
+            vocab = {}
+            index_vocab = []
+        lookup = self._token_lookup(stopwords, vocab)
+        documents, document_range = self._encode_lines(f, lookup, vocab, index_vocab)
+        f.close()
 
-        documents = documents2[:]
+        return documents, document_range, len(document_range), vocab, index_vocab
 
-        return documents, document_range, num_docs
+    def _encode_lines(self, lines, lookup, vocab, index_vocab):
+        """
+        Splits every line into sentences of token ids. Words missing from lookup are
+        added to it, vocab and index_vocab. Returns the sentences as a SentenceCorpus
+        and, for every line, the number of sentences up to its end.
+        """
+        documents = SentenceCorpus()
+        append_token = documents.tokens.append
+        end_sentence = documents.end_sentence
+        document_range = []
+        find_tokens = self.token_pattern.findall
+        for line in lines:
+            for token in find_tokens(line.lower()):
+                word_id = lookup.get(token)
+                if word_id is None:
+                    word_id = lookup[token] = vocab[token] = len(index_vocab)
+                    index_vocab.append(token)
+                elif word_id < 0:
+                    if word_id == _SENTENCE_END:
+                        end_sentence()
+                    continue
+                append_token(word_id)
+            end_sentence()
+            document_range.append(len(documents))
+        return documents, document_range
+
+    def _preprocess_input_parallel(self, filename, stopwords, vocab=None, index_vocab=None):
+        """
+        Parallel version of _preprocess_input_ids followed by _get_word_freq_ids. The
+        file is split into byte ranges aligned on lines, which self.workers processes
+        tokenize and count with vocabularies of their own. The chunks are then merged
+        in file order: their words get global ids in order of first appearance and
+        their line ends are shifted by the sentences of the previous chunks, so the
+        result is the same as the sequential one.
+        """
+        if vocab is None:
+            vocab = {}
+            index_vocab = []
+        state = {'miner': self, 'file_name': filename, 'stopwords': stopwords}
+        pool = multiprocessing.Pool(self.workers, _init_worker, (state,))
+        try:
+            chunks = pool.imap(_preprocess_chunk, _line_bounds(filename, self.workers * 4))
+            documents = SentenceCorpus()
+            document_range = []
+            total_words = 0
+            word_freq = Counter()
+            for packed_tokens, packed_offsets, packed_ends, chunk_vocab, counts in chunks:
+                #global id of every word id of the chunk
+                ids = []
+                for word in chunk_vocab:
+                    word_id = vocab.get(word)
+                    if word_id is None:
+                        word_id = vocab[word] = len(index_vocab)
+                        index_vocab.append(word)
+                    ids.append(word_id)
+                for word_id, count in zip(ids, counts):
+                    word_freq[(word_id,)] += count
+
+                tokens = array('i')
+                tokens.fromstring(packed_tokens)
+                total_words += len(tokens)
+                if ids != range(len(ids)):
+                    tokens = array('i', [ids[word_id] for word_id in tokens])
+                sentence_offsets = array('l')
+                sentence_offsets.fromstring(packed_offsets)
+                line_ends = array('i')
+                line_ends.fromstring(packed_ends)
+
+                offset = len(documents)
+                documents.extend(SentenceCorpus(tokens, sentence_offsets))
+                document_range.extend(offset + end for end in line_ends)
+        finally:
+            pool.close()
+            pool.join()
+
+        active_indices = documents.positions()
+        return (documents, document_range, len(document_range), vocab, index_vocab,
+                total_words, word_freq, active_indices)
 
     def _run_phrase_mining(self, min_support, max_phrase_size, alpha, file_name):
         """
@@ -280,41 +974,258 @@ class PhraseMining(object):
         @file_name: path to the input corpus
         """
 
-        stopwords = self._get_stopwords()
+        stopwords = self.get_stopwords()
+        instrumentation = self.instrumentation
+
+        if self.use_token_ids:
+            if self.workers > 1:
+                #tokenize and count the words of chunks of the file in parallel
+                with instrumentation.stage("preprocess"):
+                    (documents, document_range, num_docs, vocab, index_vocab,
+                     total_words, word_freq, active_indices) = self._preprocess_input_parallel(file_name, stopwords)
+            else:
+                with instrumentation.stage("preprocess"):
+                    documents, document_range, num_docs, vocab, index_vocab = self._preprocess_input_ids(file_name, stopwords)
+
+                #calculate frequency of all words
+                with instrumentation.stage("word_freq"):
+                    total_words, word_freq, active_indices = self._get_word_freq_ids(documents)
 
-        documents, document_range, num_docs = self._preprocess_input(file_name, stopwords)
+            #run frequent pattern mining, word_freq is left holding the raw counts of
+            #every candidate which are kept for incremental updates
+            with instrumentation.stage("frequent_patterns"):
+                if self.workers > 1:
+                    raw_counter = self._frequentPatternMiningSharded(documents, min_support, max_phrase_size, word_freq, active_indices)
+                else:
+                    raw_counter = self._frequentPatternMiningIds(documents, min_support, max_phrase_size, word_freq, active_indices)
 
-        #calculate frequency of all words
-        total_words, word_freq, active_indices = self._get_word_freq(documents)
+            #the sentences and their segmentation are only kept for update and
+            #save_state, which need the raw counts too
+            keep_state = self.keep_raw_counts
+            self.documents = documents if keep_state else None
+            self.document_range = document_range if keep_state else None
+            self.sentence_index = None
+            self.raw_counter = raw_counter if keep_state else None
+            self.total_words = total_words
+        else:
+            with instrumentation.stage("preprocess"):
+                documents, document_range, num_docs = self._preprocess_input(file_name, stopwords)
 
-        vocab_size = len(word_freq)
+            #calculate frequency of all words
+            with instrumentation.stage("word_freq"):
+                total_words, word_freq, active_indices = self._get_word_freq(documents)
 
-        #run frequent pattern mining 
-        hash_counter = self._frequentPatternMining(documents, min_support, max_phrase_size, word_freq, active_indices)
+            #run frequent pattern mining 
+            with instrumentation.stage("frequent_patterns"):
+                raw_counter = self._frequentPatternMining(documents, min_support, max_phrase_size, word_freq, active_indices)
+            keep_state = False
+        #word_freq is the raw counter itself
+        word_freq = active_indices = None
+        instrumentation.count("preprocess.documents", num_docs)
+        instrumentation.count("word_freq.tokens", total_words)
+
+        #prune the counts by the minimum support and compute the true count of each phrase
+        with instrumentation.stage("rectify"):
+            hash_counter, self.true_counter = self._rectify(raw_counter, min_support)
+            raw_counter = None
+        if self.use_token_ids:
+            self.hash_counter = hash_counter
+        instrumentation.count("frequent_patterns.frequent_phrases", len(hash_counter))
 
         #run agglomerative clustering
-        doc_phrases = []
-        for doc in documents:
-            doc_phrases.append(self._agglomerative_clustering(doc, hash_counter, alpha, total_words))
+        with instrumentation.stage("clustering"):
+            significance_cache = SignificanceCache(hash_counter, total_words, self.significance_cache_size)
+            doc_phrases = self._cluster_documents(documents, significance_cache, alpha)
+            significance_cache = documents = None
+        self.doc_phrases = doc_phrases if keep_state else None
 
-        #update true count of each phrase
-        self.true_counter = self._get_true_frequency(hash_counter)
+        with instrumentation.stage("partition"):
+            partitioned_docs = self._get_partitioned_docs(document_range, doc_phrases)
+            #once converted, the phrases of a sentence are freed unless they are kept
+            doc_phrases = document_range = None
+            if self.use_token_ids:
+                self._process_partitioned_id_docs(partitioned_docs, vocab, index_vocab)
+            else:
+                self._process_partitioned_docs(partitioned_docs)
 
-        partitioned_docs = self._get_partitioned_docs(document_range, doc_phrases)
-        self._process_partitioned_docs(partitioned_docs)
+        return self.partitioned_docs, self.index_vocab
+
+    def update(self, file_name):
+        """
+        Adds the documents of file_name to an already mined corpus (see mine and
+        load_state) and returns the partitioned docs and vocabulary of the whole corpus.
+
+        The new documents are counted against the raw counts of the corpus mined so
+        far. Old sentences are counted again only where a phrase that becomes frequent
+        with the new documents makes new candidates, so the counts are the ones mining
+        the whole corpus would give. Then the new sentences are segmented, along with
+        the old sentences that contain a phrase of several words whose count changed.
+        The other old sentences keep their segmentation, even though total_words and
+        the counts of single words have grown, which only shifts the expected
+        occurrences of their phrases.
+        """
+        if not self.use_token_ids:
+            raise ValueError("incremental updates require use_token_ids")
+        if self.raw_counter is None:
+            raise ValueError("incremental updates require keep_raw_counts")
+
+        stopwords = self.get_stopwords()
+        instrumentation = self.instrumentation
+        if self.workers > 1:
+            with instrumentation.stage("preprocess"):
+                (documents, document_range, num_docs, vocab, index_vocab,
+                 total_words, word_freq, active_indices) = self._preprocess_input_parallel(
+                    file_name, stopwords, self.vocab, self.index_vocab)
+        else:
+            with instrumentation.stage("preprocess"):
+                documents, document_range, num_docs, vocab, index_vocab = self._preprocess_input_ids(
+                    file_name, stopwords, self.vocab, self.index_vocab)
+
+            with instrumentation.stage("word_freq"):
+                total_words, word_freq, active_indices = self._get_word_freq_ids(documents)
+        self.total_words += total_words
+        instrumentation.count("preprocess.documents", num_docs)
+        instrumentation.count("word_freq.tokens", total_words)
+
+        with instrumentation.stage("frequent_patterns"):
+            changed_keys = self._update_frequent_patterns(documents, active_indices, word_freq)
+
+        with instrumentation.stage("rectify"):
+            hash_counter, self.true_counter = self._rectify(self.raw_counter, self.min_support)
+        instrumentation.count("frequent_patterns.frequent_phrases", len(hash_counter))
+
+        with instrumentation.stage("clustering"):
+            #frequent phrases of several words whose count changed; counts only grow,
+            #so a phrase frequent before the update is still frequent
+            changed_phrases = set(key for key in changed_keys if len(key) > 1 and key in hash_counter)
+            self.hash_counter = hash_counter
+
+            affected = []
+            if changed_phrases:
+                sentence_offsets = self.documents.sentence_offsets
+                for position in self._phrase_positions(changed_phrases):
+                    doc_index = bisect_right(sentence_offsets, position) - 1
+                    if not affected or affected[-1] != doc_index:
+                        affected.append(doc_index)
+            significance_cache = SignificanceCache(hash_counter, self.total_words, self.significance_cache_size)
+            affected_phrases = self._cluster_documents(
+                [self.documents[doc_index] for doc_index in affected], significance_cache, self.alpha)
+            for doc_index, phrases in zip(affected, affected_phrases):
+                self.doc_phrases[doc_index] = phrases
+
+            offset = len(self.documents)
+            num_old_docs = len(self.document_range)
+            self.documents.extend(documents)
+            self.document_range.extend(offset + end for end in document_range)
+            if self.sentence_index is not None:
+                self._index_sentences(offset)
+            self.doc_phrases.extend(self._cluster_documents(documents, significance_cache, self.alpha))
+
+        with instrumentation.stage("partition"):
+            #only the documents holding a segmented sentence are partitioned again
+            changed_documents = sorted(set(bisect_right(self.document_range, doc_index) for doc_index in affected))
+            changed_documents.extend(range(num_old_docs, len(self.document_range)))
+            partitioned_docs = list(self.partitioned_docs)
+            for document_index in changed_documents:
+                start = self.document_range[document_index - 1] if document_index > 0 else 0
+                document = []
+                for doc_index in range(start, self.document_range[document_index]):
+                    document.extend(list(phrase) for phrase in self.doc_phrases[doc_index])
+                if document_index < num_old_docs:
+                    partitioned_docs[document_index] = document
+                else:
+                    partitioned_docs.append(document)
+            self.partitioned_docs = partitioned_docs
+            self.vocab = vocab
+            self.index_vocab = index_vocab
 
         return self.partitioned_docs, self.index_vocab
 
-    def get_frequent_phrases(self, min_support):
+    def save_state(self, path):
         """
-        Returns the most frequent phrases in the corpus that occur more than 
-        the minimum support in descending order of frequency
+        Stores what update needs to extend the mined corpus: the parameters, the
+        vocabulary, the raw phrase counts, total_words, the encoded sentences and
+        their segmentation.
         """
-        frequent_phrases = []
-        for key,value in self.true_counter.most_common():
-            if value >= min_support and len(key.split(" "))>1:
-                frequent_phrases.append((key, value))
-            elif value < min_support:
-                break
-        return frequent_phrases
+        if not self.use_token_ids:
+            raise ValueError("saving the mining state requires use_token_ids")
+        if self.raw_counter is None:
+            raise ValueError("saving the mining state requires keep_raw_counts")
+
+        # the segmentation is kept as the length of each phrase, in corpus order
+        phrase_lengths = array('i')
+        for phrases in self.doc_phrases:
+            phrase_lengths.extend(len(phrase) for phrase in phrases)
+
+        state = {
+            'min_support': self.min_support,
+            'max_phrase_size': self.max_phrase_size,
+            'alpha': self.alpha,
+            'sentence_delimiters': self.sentence_delimiters,
+            'stopwords_file': self.stopwords_file,
+            'index_vocab': self.index_vocab,
+            'total_words': self.total_words,
+            'raw_counter': dict(self.raw_counter),
+            'tokens': self.documents.tokens,
+            'sentence_offsets': self.documents.sentence_offsets,
+            'document_range': self.document_range,
+            'phrase_lengths': phrase_lengths,
+        }
+        f = open(path, 'wb')
+        cPickle.dump(state, f, cPickle.HIGHEST_PROTOCOL)
+        f.close()
+
+    @classmethod
+    def load_state(cls, path, workers=1):
+        """
+        Returns a PhraseMining holding the state stored by save_state, ready for update.
+        """
+        f = open(path, 'rb')
+        state = cPickle.load(f)
+        f.close()
 
+        miner = cls(None, state['min_support'], state['max_phrase_size'], state['alpha'], workers=workers,
+                    sentence_delimiters=state.get('sentence_delimiters', ".,;!?"),
+                    stopwords_file=state.get('stopwords_file', STOPWORDS_FILE))
+        miner.index_vocab = state['index_vocab']
+        miner.vocab = dict((word, word_id) for word_id, word in enumerate(miner.index_vocab))
+        miner.total_words = state['total_words']
+        miner.raw_counter = Counter(state['raw_counter'])
+        miner.hash_counter, miner.true_counter = miner._rectify(miner.raw_counter, miner.min_support)
+        if 'documents' in state:
+            #states saved before the sentences were stored flat
+            miner.documents = SentenceCorpus.from_sentences(state['documents'])
+        else:
+            miner.documents = SentenceCorpus(state['tokens'], state['sentence_offsets'])
+        miner.document_range = state['document_range']
+
+        miner.doc_phrases = []
+        phrase_lengths = iter(state['phrase_lengths'])
+        for doc in miner.documents:
+            phrases = []
+            start = 0
+            while start < len(doc):
+                end = start + next(phrase_lengths)
+                phrases.append(tuple(doc[start:end]))
+                start = end
+            miner.doc_phrases.append(phrases)
+
+        partitioned_docs = miner._get_partitioned_docs(miner.document_range, miner.doc_phrases)
+        miner._process_partitioned_id_docs(partitioned_docs, miner.vocab, miner.index_vocab)
+        return miner
+
+    def get_frequent_phrases(self, min_support, top_phrases=None):
+        """
+        Returns the phrases of more than one word that occur at least min_support
+        times, in descending order of frequency. When top_phrases is given only the
+        top_phrases most frequent ones are returned, selected with a heap instead of
+        sorting every phrase. Only the returned phrases are turned into strings.
+        """
+        candidates = ((key, value) for key, value in self.true_counter.iteritems()
+                      if value >= min_support and (len(key) > 1 if isinstance(key, tuple) else " " in key))
+        if top_phrases is None:
+            frequent_phrases = sorted(candidates, key=itemgetter(1), reverse=True)
+        else:
+            frequent_phrases = heapq.nlargest(top_phrases, candidates, key=itemgetter(1))
+        return [(" ".join(self.index_vocab[word] for word in key) if isinstance(key, tuple) else key, value)
+                for key, value in frequent_phrases]
@@ -0,0 +1,174 @@
+import os
+import phrase_mining
+import phrase_lda
+import utils
+from mining_cache import MiningCache
+from phrase_index import PhraseIndex
+
+
+class TopMine(object):
+    """
+    Runs phrase mining and PhraseLDA in a single process. The partitioned
+    documents and the vocabulary are handed from PhraseMining to PhraseLDA in
+    memory; the intermediate files are only written when asked for.
+    :param file_name:
+        path to the input corpus.
+    :param num_topics:
+        number of topics of PhraseLDA.
+    :param min_support:
+        minimum support of the mined phrases.
+    :param max_phrase_size:
+        maximum allowed phrase size.
+    :param significance_threshold:
+        threshold for merging two phrases during the segmentation (the
+        ``alpha`` of PhraseMining).
+    :param sentence_delimiters:
+        characters ending a sentence during the mining.
+    :param alpha:
+        initial document/topic Dirichlet hyperparameter of PhraseLDA.
+    :param beta:
+        initial topic/word Dirichlet hyperparameter of PhraseLDA.
+    :param iterations:
+        number of Gibbs sampling iterations.
+    :param optimization_iterations:
+        iterations between two hyperparameter optimizations, or None.
+    :param optimization_burnin:
+        iterations before the hyperparameter optimization starts.
+    :param sampler:
+        PhraseLDA sampler: "python", "numpy" or "sparse".
+    :param mining_workers:
+        number of processes used by the phrase mining.
+    :param lda_workers:
+        number of processes used by PhraseLDA. With more than one, the sampling
+        is the approximate AD-LDA one, so it defaults to 1.
+    :param likelihood_iterations:
+        iterations between two log-likelihood computations, or None.
+    :param convergence_tolerance:
+        relative log-likelihood improvement under which sampling stops, or None.
+    :param output_dir:
+        directory receiving the frequent phrases, the topics and the phrase index.
+    :param intermediate_dir:
+        directory receiving the intermediate files, when store_intermediate is set.
+    :param store_intermediate:
+        also writes the partitioned docs, the vocabulary, the phrase topics
+        and the PhraseLDA model to intermediate_dir.
+    :param intermediate_format:
+        format of the stored partitioned docs: "binary" or "text".
+    :param instrumentation:
+        an instrumentation.Instrumentation shared by the mining and the sampling.
+    :param cache_dir:
+        directory of a MiningCache. The mining results are reused from it when
+        the input, the mining parameters and the stopwords are unchanged. Set to
+        None to always mine.
+    :param cache_max_bytes:
+        maximum size of the cache.
+    :param top_phrases:
+        maximum number of frequent phrases, and of phrases of each topic, that
+        are returned and stored, or None for all of them.
+    """
+
+    def __init__(self, file_name, num_topics=4, min_support=10, max_phrase_size=10,
+                 significance_threshold=4, sentence_delimiters=".,;!?", alpha=4, beta=0.01, iterations=1100,
+                 optimization_iterations=50, optimization_burnin=100, sampler="python",
+                 mining_workers=1, lda_workers=1, likelihood_iterations=None, convergence_tolerance=None,
+                 output_dir="output", intermediate_dir="intermediate_output",
+                 store_intermediate=False, intermediate_format="binary", instrumentation=None,
+                 cache_dir=None, cache_max_bytes=1 << 30, top_phrases=None):
+        if intermediate_format not in ("binary", "text"):
+            raise ValueError("unknown intermediate format: {0}".format(intermediate_format))
+        self.file_name = file_name
+        self.num_topics = num_topics
+        self.min_support = min_support
+        self.max_phrase_size = max_phrase_size
+        self.significance_threshold = significance_threshold
+        self.sentence_delimiters = sentence_delimiters
+        self.alpha = alpha
+        self.beta = beta
+        self.iterations = iterations
+        self.optimization_iterations = optimization_iterations
+        self.optimization_burnin = optimization_burnin
+        self.sampler = sampler
+        self.mining_workers = mining_workers
+        self.lda_workers = lda_workers
+        self.likelihood_iterations = likelihood_iterations
+        self.convergence_tolerance = convergence_tolerance
+        self.output_dir = output_dir
+        self.intermediate_dir = intermediate_dir
+        self.store_intermediate = store_intermediate
+        self.intermediate_format = intermediate_format
+        self.instrumentation = instrumentation
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
+        self.top_phrases = top_phrases
+
+    def mine(self):
+        """
+        Runs phrase mining, or reuses its results from the cache, and returns the
+        partitioned docs, the vocabulary, the frequent phrases and the phrase index,
+        which has no topic counts yet.
+        """
+        miner = phrase_mining.PhraseMining(self.file_name, self.min_support, self.max_phrase_size,
+                                           self.significance_threshold, workers=self.mining_workers,
+                                           sentence_delimiters=self.sentence_delimiters,
+                                           keep_raw_counts=False, instrumentation=self.instrumentation)
+        if self.cache_dir is None:
+            return self._mine(miner)
+
+        cache = MiningCache(self.cache_dir, self.cache_max_bytes)
+        parameters = {'min_support': self.min_support, 'max_phrase_size': self.max_phrase_size,
+                      'alpha': self.significance_threshold,
+                      'sentence_delimiters': self.sentence_delimiters, 'top_phrases': self.top_phrases}
+        key = cache.key(self.file_name, parameters, miner.get_stopwords())
+        results = cache.load(key)
+        if results is None:
+            results = self._mine(miner)
+            cache.store(key, *results)
+        return results
+
+    def _mine(self, miner):
+        partitioned_docs, index_vocab = miner.mine()
+        frequent_phrases = miner.get_frequent_phrases(self.min_support, self.top_phrases)
+        phrase_index = PhraseIndex.from_counters(miner.hash_counter, miner.true_counter, index_vocab)
+        return partitioned_docs, index_vocab, frequent_phrases, phrase_index
+
+    def topic_model(self, partitioned_docs, index_vocab):
+        """
+        Returns the PhraseLDA model of the partitioned docs, ready to run.
+        """
+        return phrase_lda.PhraseLDA(partitioned_docs, index_vocab, self.num_topics, self.alpha,
+                                    self.beta, self.iterations, self.optimization_iterations,
+                                    self.optimization_burnin, sampler=self.sampler, workers=self.lda_workers,
+                                    likelihood_iterations=self.likelihood_iterations,
+                                    convergence_tolerance=self.convergence_tolerance,
+                                    top_phrases=self.top_phrases,
+                                    instrumentation=self.instrumentation)
+
+    def run(self):
+        """
+        Mines the phrases, samples the topics, stores the results and returns the
+        PhraseLDA model.
+        """
+        partitioned_docs, index_vocab, frequent_phrases, phrase_index = self.mine()
+        utils.store_frequent_phrases(frequent_phrases, self._output_path("frequent_phrases.txt"))
+        if self.store_intermediate:
+            if self.intermediate_format == "binary":
+                utils.store_partitioned_corpus(partitioned_docs, self._intermediate_path("partitioneddocs.bin"))
+            else:
+                utils.store_partitioned_docs(partitioned_docs, self._intermediate_path("partitioneddocs.txt"))
+            utils.store_vocab(index_vocab, self._intermediate_path("vocab.txt"))
+
+        plda = self.topic_model(partitioned_docs, index_vocab)
+        document_phrase_topics, most_frequent_topics = plda.run()
+        utils.store_most_frequent_topics(most_frequent_topics, self._output_path("topic"))
+        phrase_index.add_topic_counts(plda)
+        phrase_index.save(self._output_path("phrase_index.bin"))
+        if self.store_intermediate:
+            utils.store_phrase_topics(document_phrase_topics, self._intermediate_path("phrase_topics.txt"))
+            plda.save_model(self._intermediate_path("phrase_lda_model.pkl"))
+        return plda
+
+    def _output_path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def _intermediate_path(self, name):
+        return os.path.join(self.intermediate_dir, name)
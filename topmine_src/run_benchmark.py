@@ -0,0 +1,185 @@
+import phrase_mining
+import phrase_lda
+import sys
+import os
+import shutil
+import time
+import json
+import random
+import resource
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from pipeline import TopMine
+from instrumentation import Instrumentation
+
+arguments = sys.argv
+print 'Running benchmark...'
+
+file_name = arguments[1] if len(arguments) > 1 else "input/dblp_5k.txt"
+
+# JSON report, one entry per corpus
+report_file = arguments[2] if len(arguments) > 2 else "output/benchmark.json"
+
+# sizes of the benchmarked corpora, as multiples of the input corpus. The larger
+# corpora are sampled line by line from the input corpus.
+scales = [1, 10, 100]
+
+# phrase mining parameters, as in run_phrase_mining.py
+min_support = 10
+alpha = 4
+max_phrase_size = 10
+
+# PhraseLDA parameters. The sweeps are timed without hyperparameter optimization.
+num_topics = 4
+lda_iterations = 10
+sampler = "python"
+
+def synthetic_corpus(file_name, scale, seed=0):
+    """
+    Writes scale times as many lines as file_name has, drawn at random from it, to a
+    temporary file and returns its path.
+    """
+    lines = open(file_name, 'r').readlines()
+    generator = random.Random(seed)
+    handle, path = tempfile.mkstemp(suffix=".txt")
+    f = os.fdopen(handle, 'w')
+    for __ in range(len(lines) * scale):
+        f.write(lines[generator.randrange(len(lines))])
+    f.close()
+    return path
+
+def timed(stage, work, result):
+    start = time.time()
+    output = work()
+    result[stage] = {'seconds': time.time() - start}
+    return output
+
+def throughput(result, stage, **counts):
+    seconds = result[stage]['seconds']
+    for name, count in counts.items():
+        result[stage][name] = count
+        result[stage][name + '_per_second'] = count / seconds if seconds > 0 else None
+
+def benchmark_corpus(path):
+    """
+    Runs every stage of phrase mining and a few PhraseLDA sweeps on the corpus and
+    returns their timings and throughputs.
+    """
+    result = {}
+    instrumentation = Instrumentation()
+    miner = phrase_mining.PhraseMining(path, min_support, max_phrase_size, alpha, keep_raw_counts=False,
+                                       instrumentation=instrumentation)
+    stopwords = miner.get_stopwords()
+
+    documents, document_range, num_docs, vocab, index_vocab = timed(
+        'preprocess', lambda: miner._preprocess_input_ids(path, stopwords), result)
+    total_words, word_freq, active_indices = timed(
+        'word_freq', lambda: miner._get_word_freq_ids(documents), result)
+    throughput(result, 'preprocess', documents=num_docs, tokens=total_words)
+    throughput(result, 'word_freq', tokens=total_words)
+
+    raw_counter = timed('frequent_patterns', lambda: miner._frequentPatternMiningIds(
+        documents, min_support, max_phrase_size, word_freq, active_indices), result)
+    # the counts are pruned level by level, so the candidates are counted by the
+    # instrumentation rather than taken from the counter
+    candidate_phrases = dict((name.rsplit('_', 1)[1], count)
+                             for name, count in instrumentation.counters.items()
+                             if name.startswith("frequent_patterns.candidates.length_"))
+    throughput(result, 'frequent_patterns', tokens=total_words,
+               candidate_phrases=sum(candidate_phrases.values()))
+    result['frequent_patterns']['candidate_phrases_by_length'] = candidate_phrases
+
+    hash_counter, true_counter = timed('rectify', lambda: miner._rectify(raw_counter, min_support), result)
+    throughput(result, 'rectify', counted_phrases=len(raw_counter), frequent_phrases=len(hash_counter))
+
+    significance_cache = phrase_mining.SignificanceCache(hash_counter, total_words)
+    doc_phrases = timed('clustering', lambda: miner._cluster_documents(
+        documents, significance_cache, alpha), result)
+    throughput(result, 'clustering', tokens=total_words,
+               phrases=sum(len(phrases) for phrases in doc_phrases))
+
+    partitioned_docs = miner._get_partitioned_docs(document_range, doc_phrases)
+    miner._process_partitioned_id_docs(partitioned_docs, vocab, index_vocab)
+
+    plda = phrase_lda.PhraseLDA(miner.partitioned_docs, miner.index_vocab, num_topics,
+                                iterations=lda_iterations, optimization_iterations=None,
+                                sampler=sampler)
+    timed('lda_initialize', plda._initialize, result)
+    def sweeps():
+        for __ in range(lda_iterations):
+            plda._run_sweep()
+    timed('lda_sweeps', sweeps, result)
+    throughput(result, 'lda_sweeps', sweeps=lda_iterations,
+               phrases=lda_iterations * plda.num_phrases, tokens=lda_iterations * len(plda.corpus.tokens))
+
+    benchmark_cache(path, result)
+
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def benchmark_cache(path, result):
+    """
+    Mines the corpus through TopMine twice with the same mining cache, first
+    missing then hitting it, and flags a hit slower than the miss.
+    """
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for stage in ('cache_miss', 'cache_hit'):
+            topmine = TopMine(path, num_topics=num_topics, min_support=min_support,
+                              max_phrase_size=max_phrase_size, significance_threshold=alpha,
+                              sampler=sampler, cache_dir=cache_dir)
+            timed(stage, topmine.mine, result)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    result['cache_hit_slower'] = result['cache_hit']['seconds'] > result['cache_miss']['seconds']
+
+def run_in_process(connection, scale):
+    """
+    Benchmarks one corpus in a process of its own, so that its peak RSS is not
+    inflated by the corpora benchmarked before it.
+    """
+    if scale == 1:
+        path = file_name
+    else:
+        path = synthetic_corpus(file_name, scale)
+    try:
+        result = benchmark_corpus(path)
+    finally:
+        if path != file_name:
+            os.remove(path)
+    result['scale'] = scale
+    connection.send(result)
+    connection.close()
+
+def git_revision():
+    try:
+        return subprocess.Popen(["git", "rev-parse", "HEAD"], stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+report = {
+    'input': file_name,
+    'revision': git_revision(),
+    'python': platform.python_implementation() + " " + platform.python_version(),
+    'parameters': {'min_support': min_support, 'alpha': alpha, 'max_phrase_size': max_phrase_size,
+                   'num_topics': num_topics, 'lda_iterations': lda_iterations, 'sampler': sampler},
+    'corpora': [],
+}
+for scale in scales:
+    print 'scale', scale
+    parent_connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=run_in_process, args=(child_connection, scale))
+    process.start()
+    # the parent's end is the only one left open, so a failed benchmark raises EOFError
+    child_connection.close()
+    report['corpora'].append(parent_connection.recv())
+    process.join()
+
+f = open(report_file, 'w')
+json.dump(report, f, indent=2, sort_keys=True)
+f.close()
+print json.dumps(report, indent=2, sort_keys=True)
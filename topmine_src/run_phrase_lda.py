@@ -1,6 +1,9 @@
 import phrase_lda
 import sys
+import os
 import utils
+from phrase_index import PhraseIndex
+from instrumentation import Instrumentation
 
 arguments = sys.argv
 
@@ -10,14 +13,46 @@ optimization_burnin = 100
 alpha = 4
 optimization_iterations = 50
 beta = 0.01
+# format of the partitioned docs written by run_phrase_mining.py: "binary" or "text"
+intermediate_format = "binary"
+# number of processes sampling shards of the documents in parallel
+workers = 1
+# the sampling state is saved every checkpoint_iterations iterations; pass
+# --resume as the second argument to continue an interrupted run from it
+checkpoint_path = "intermediate_output/phrase_lda_checkpoint.pkl"
+checkpoint_iterations = 100
+resume = len(arguments) > 2 and arguments[2] == "--resume"
+# the log-likelihood is computed every likelihood_iterations iterations; set
+# convergence_tolerance (e.g. 1e-4) to stop once its relative improvement is lower
+likelihood_iterations = 50
+convergence_tolerance = None
+# number of most frequent phrases stored for each topic, or None for all of them
+top_phrases = None
+# JSON file receiving the time of every stage and the sampling counters, or None
+metrics_file = None
+instrumentation = Instrumentation() if metrics_file is not None else None
 
 print 'Running PhraseLDA...'
 
-partitioned_docs = utils.load_partitioned_docs()
+if intermediate_format == "binary":
+    partitioned_docs = utils.load_partitioned_corpus()
+else:
+    partitioned_docs = utils.load_partitioned_docs()
 vocab_file = utils.load_vocab()
 
-plda = phrase_lda.PhraseLDA( partitioned_docs, vocab_file, num_topics , alpha, beta, iteration, optimization_iterations, optimization_burnin);
+plda = phrase_lda.PhraseLDA( partitioned_docs, vocab_file, num_topics , alpha, beta, iteration, optimization_iterations, optimization_burnin, workers=workers, checkpoint_path=checkpoint_path, checkpoint_iterations=checkpoint_iterations, likelihood_iterations=likelihood_iterations, convergence_tolerance=convergence_tolerance, top_phrases=top_phrases, instrumentation=instrumentation);
 
-document_phrase_topics, most_frequent_topics = plda.run()
+if resume:
+    document_phrase_topics, most_frequent_topics = plda.run(checkpoint_path)
+else:
+    document_phrase_topics, most_frequent_topics = plda.run()
 utils.store_phrase_topics(document_phrase_topics)
-utils.store_most_frequent_topics(most_frequent_topics)
\ No newline at end of file
+utils.store_most_frequent_topics(most_frequent_topics)
+plda.save_model("intermediate_output/phrase_lda_model.pkl")
+# adds the topic counts to the phrase index written by run_phrase_mining.py
+if os.path.exists("intermediate_output/phrase_index.bin"):
+    phrase_index = PhraseIndex.load("intermediate_output/phrase_index.bin")
+    phrase_index.add_topic_counts(plda)
+    phrase_index.save("output/phrase_index.bin")
+if instrumentation is not None:
+    instrumentation.write(metrics_file)
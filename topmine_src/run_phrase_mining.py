@@ -1,6 +1,8 @@
 import phrase_mining
 import sys
 import utils
+from phrase_index import PhraseIndex
+from instrumentation import Instrumentation
 
 arguments = sys.argv
 print 'Running Phrase Mining...'
@@ -17,9 +19,33 @@ alpha=4
 # length of the maximum phrase size
 max_phrase_size=10
 
-phrase_miner = phrase_mining.PhraseMining(file_name, min_support, max_phrase_size, alpha);
+# characters ending a sentence. Phrases never span two sentences.
+sentence_delimiters=".,;!?"
+
+# number of most frequent phrases stored, or None for all of them
+top_phrases=None
+
+# format of the partitioned docs handed over to PhraseLDA: "binary" or "text"
+intermediate_format="binary"
+
+# number of processes used to tokenize the input, count frequent patterns and segment the sentences
+workers=1
+
+# JSON file receiving the time of every stage and the mining counters, or None
+metrics_file=None
+instrumentation = Instrumentation() if metrics_file is not None else None
+
+phrase_miner = phrase_mining.PhraseMining(file_name, min_support, max_phrase_size, alpha, workers=workers, sentence_delimiters=sentence_delimiters, keep_raw_counts=False, instrumentation=instrumentation);
 partitioned_docs, index_vocab = phrase_miner.mine()
-frequent_phrases = phrase_miner.get_frequent_phrases(min_support)
-utils.store_partitioned_docs(partitioned_docs)
+frequent_phrases = phrase_miner.get_frequent_phrases(min_support, top_phrases)
+if intermediate_format == "binary":
+    utils.store_partitioned_corpus(partitioned_docs)
+else:
+    utils.store_partitioned_docs(partitioned_docs)
 utils.store_vocab(index_vocab)
-utils.store_frequent_phrases(frequent_phrases)
\ No newline at end of file
+utils.store_frequent_phrases(frequent_phrases)
+# index of the mined phrases and their counts, completed with the topic counts by run_phrase_lda.py
+PhraseIndex.from_counters(phrase_miner.hash_counter, phrase_miner.true_counter, index_vocab).save(
+    "intermediate_output/phrase_index.bin")
+if instrumentation is not None:
+    instrumentation.write(metrics_file)
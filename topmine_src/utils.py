@@ -1,3 +1,20 @@
+import mmap
+import struct
+from array import array
+from corpus import PartitionedCorpus
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# header of the binary partitioned docs: magic, version, token and offset item
+# sizes, then the number of tokens, phrase offsets and document offsets.
+# Values are stored in native byte order.
+PARTITIONED_CORPUS_MAGIC = "TMPC"
+PARTITIONED_CORPUS_VERSION = 1
+PARTITIONED_CORPUS_HEADER = struct.Struct("=4sIIIQQQ")
+
 def store_partitioned_docs(partitioned_docs, path="intermediate_output/partitioneddocs.txt"):
     f = open(path, 'w')
     for document in partitioned_docs:
@@ -20,11 +37,75 @@ def load_partitioned_docs(path="intermediate_output/partitioneddocs.txt"):
         partitioned_docs.append(partitioned_doc)
     return partitioned_docs
 
+def store_partitioned_corpus(partitioned_docs, path="intermediate_output/partitioneddocs.bin"):
+    """
+    Stores the partitioned docs in a binary columnar file: a small header
+    followed by the token ids, the phrase offsets and the document offsets.
+    Accepts a list of documents or a PartitionedCorpus.
+    """
+    if not isinstance(partitioned_docs, PartitionedCorpus):
+        partitioned_docs = PartitionedCorpus.from_partitioned_docs(partitioned_docs)
+    tokens = array('i', partitioned_docs.tokens)
+    phrase_offsets = array('l', partitioned_docs.phrase_offsets)
+    document_offsets = array('l', partitioned_docs.document_offsets)
+
+    f = open(path, 'wb')
+    f.write(PARTITIONED_CORPUS_HEADER.pack(
+        PARTITIONED_CORPUS_MAGIC, PARTITIONED_CORPUS_VERSION, tokens.itemsize, phrase_offsets.itemsize,
+        len(tokens), len(phrase_offsets), len(document_offsets)))
+    tokens.tofile(f)
+    # keep the offsets aligned on their item size
+    f.write("\0" * (-f.tell() % phrase_offsets.itemsize))
+    phrase_offsets.tofile(f)
+    document_offsets.tofile(f)
+    f.close()
+
+def load_partitioned_corpus(path="intermediate_output/partitioneddocs.bin", memory_map=False):
+    """
+    Loads partitioned docs stored by store_partitioned_corpus as a PartitionedCorpus.
+    The arrays are read in bulk, nothing is parsed. With memory_map the arrays are
+    read-only NumPy views of the memory-mapped file instead, which saves memory when
+    only part of the corpus is read but makes every element access much slower, so
+    PhraseLDA copies them back into arrays.
+    """
+    f = open(path, 'rb')
+    header = f.read(PARTITIONED_CORPUS_HEADER.size)
+    magic, version, token_size, offset_size, num_tokens, num_phrase_offsets, num_document_offsets = \
+        PARTITIONED_CORPUS_HEADER.unpack(header)
+    if magic != PARTITIONED_CORPUS_MAGIC or version != PARTITIONED_CORPUS_VERSION:
+        raise ValueError("{0} is not a partitioned corpus file".format(path))
+    if token_size != array('i').itemsize or offset_size != array('l').itemsize:
+        raise ValueError("{0} was written on a platform with different integer sizes".format(path))
+
+    tokens_start = PARTITIONED_CORPUS_HEADER.size
+    phrase_offsets_start = tokens_start + num_tokens * token_size
+    phrase_offsets_start += -phrase_offsets_start % offset_size
+    document_offsets_start = phrase_offsets_start + num_phrase_offsets * offset_size
+
+    if memory_map:
+        if numpy is None:
+            raise ImportError("memory mapping the partitioned docs requires NumPy")
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        tokens = numpy.frombuffer(buf, numpy.dtype('i'), num_tokens, tokens_start)
+        phrase_offsets = numpy.frombuffer(buf, numpy.dtype('l'), num_phrase_offsets, phrase_offsets_start)
+        document_offsets = numpy.frombuffer(buf, numpy.dtype('l'), num_document_offsets, document_offsets_start)
+    else:
+        tokens = array('i')
+        tokens.fromfile(f, num_tokens)
+        f.seek(phrase_offsets_start)
+        phrase_offsets = array('l')
+        phrase_offsets.fromfile(f, num_phrase_offsets)
+        document_offsets = array('l')
+        document_offsets.fromfile(f, num_document_offsets)
+        f.close()
+    return PartitionedCorpus(tokens, phrase_offsets, document_offsets)
+
 def store_vocab(index_vocab, path="intermediate_output/vocab.txt"):
     """
     Stores vocabulary into a file.
     """
-    f = open('intermediate_output/vocab.txt', 'w')
+    f = open(path, 'w')
     for word in index_vocab:
         f.write(word+"\n")
     f.close()
@@ -54,6 +135,7 @@ def store_phrase_topics(document_phrase_topics, path="intermediate_output/phrase
     for document in document_phrase_topics:
         f.write(",".join(str(phrase) for phrase in document))
         f.write("\n")
+    f.close()
 
 def store_most_frequent_topics(most_frequent_topics, prefix_path="output/topic"):
     for topic_index, topic in enumerate(most_frequent_topics):
@@ -62,15 +144,3 @@ def store_most_frequent_topics(most_frequent_topics, prefix_path="output/topic")
         for phrase, val in topic:
             f.write(str.format("{0} {1}\n",phrase, val))
         f.close()
-
-def _get_string_phrase(phrase, index_vocab):
-    """
-    Returns the string representation of the phrase.
-    """
-    res = ""
-    for vocab_id in phrase.split():
-        if res == "":
-            res += index_vocab[int(vocab_id)]
-        else:
-            res += " " + index_vocab[int(vocab_id)]
-    return res